@@ -34,15 +34,22 @@ def create_app() -> "Flask":
 
     # pylint: disable=import-outside-toplevel
     from . import db, fridge_data
+    from .write_buffer import DURABILITY_MODES, init_write_buffer
 
     # Create and configure the app
     app = Flask(__name__)
 
     # Load config file
     app.config.from_object(config.SERVER)
+    if app.config["WRITE_DURABILITY"] not in DURABILITY_MODES:
+        raise ValueError(
+            f"Invalid WRITE_DURABILITY {app.config['WRITE_DURABILITY']}. "
+            f"Must be one of {', '.join(DURABILITY_MODES)}"
+        )
 
     # Initialize db
     db.db.init_app(app)
+    init_write_buffer(app)
 
     # Create a blank homepage
     @app.route("/")
@@ -0,0 +1,123 @@
+"""
+Per-process cache of responses for historical data. Once a time range is far enough in
+the past, readings are rarely added to it, so the response for the range rarely changes.
+Each response is stored with the version of the fridge table it was read from, and is
+checked for later writes to its range before it is served.
+Responses are stored gzip compressed, and served directly to clients that accept gzip.
+The least recently used responses are evicted once the cache reaches its maximum size.
+"""
+
+import gzip
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic
+from typing import Callable, Hashable, Optional
+
+from flask import Response
+
+# Compression level used for cached responses. Higher levels are much slower for large
+# responses, for little reduction in size.
+COMPRESS_LEVEL = 6
+
+_cache: Optional["ResponseCache"] = None
+_cache_lock = Lock()
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    mimetype: str
+    # Version of the fridge table the response was read from
+    version: int = 0
+    created: float = field(default_factory=monotonic)
+
+
+class ResponseCache:
+    def __init__(self, max_size: int):
+        """
+        Create a cache holding up to max_size bytes of compressed responses
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._entries: OrderedDict[Hashable, CachedResponse] = OrderedDict()
+        self._lock = Lock()
+
+    def get(
+        self,
+        key: Hashable,
+        accept_gzip: bool = True,
+        is_valid: Optional[Callable[[CachedResponse], bool]] = None,
+    ) -> Optional[Response]:
+        """
+        Return the cached response for key, or None if it isn't cached. If is_valid is
+        given, responses for which it returns False are removed from the cache. If the
+        client doesn't accept gzip, the response is decompressed.
+        """
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            self._entries.move_to_end(key)
+        if is_valid is not None and not is_valid(cached):
+            self.remove(key, cached)
+            return None
+
+        if not accept_gzip:
+            return Response(gzip.decompress(cached.body), mimetype=cached.mimetype)
+        r = Response(cached.body, mimetype=cached.mimetype)
+        r.headers["Content-Encoding"] = "gzip"
+        return r
+
+    def put(self, key: Hashable, response: Response, version: int = 0):
+        """
+        Compress and store a response, read from the given version of a fridge table.
+        Responses larger than the cache before compression aren't stored, to avoid
+        spending time compressing responses that would evict most of the cache.
+        """
+        body = response.get_data()
+        if len(body) > self.max_size:
+            return
+        cached = CachedResponse(
+            gzip.compress(body, compresslevel=COMPRESS_LEVEL), response.mimetype, version
+        )
+        if len(cached.body) > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self._entries[key] = cached
+            self.size += len(cached.body)
+            # Evict the least recently used responses
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def remove(self, key: Hashable, cached: Optional[CachedResponse] = None):
+        """
+        Remove the response for key from the cache. If cached is given, the response is
+        only removed if it hasn't been replaced since.
+        """
+        with self._lock:
+            if cached is not None and self._entries.get(key) is not cached:
+                return
+            removed = self._entries.pop(key, None)
+            if removed is not None:
+                self.size -= len(removed.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def get_response_cache(max_size: int) -> ResponseCache:
+    """
+    Return the response cache for this process, creating it if necessary
+    """
+    global _cache  # pylint: disable=global-statement
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(max_size)
+        return _cache
@@ -33,6 +33,38 @@ class ServerConfig:
     DEBUG: bool = False
     SQLALCHEMY_RECORD_QUERIES: bool = False
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
+    # Cache fridge and sensor metadata for this many seconds in each worker. Sensors added
+    # by other processes become available once the cache expires.
+    METADATA_CACHE_TTL: float = 60.0
+    # Publish new readings to clients of the ?live stream. Note that each connected
+    # client holds a worker thread for as long as it is connected.
+    LIVE_UPDATES: bool = False
+    # Maximum number of ?live streams open in each worker process. Further streams are
+    # rejected with a 503. This should be less than the number of threads per process
+    # (threads in uwsgi.ini), so that threads remain free to serve other requests.
+    LIVE_MAX_STREAMS: int = 16
+    # Maximum size of the cache of compressed responses for historical data in each worker,
+    # in bytes. Set to 0 to disable the cache.
+    RESPONSE_CACHE_SIZE: int = 64 * 1024 * 1024
+    # Responses are cached for time ranges ending more than this many seconds ago. Cached
+    # responses are recomputed when readings in their range are written.
+    RESPONSE_CACHE_DELAY: float = 600.0
+    # When uploads are acknowledged. "sync" writes each upload before responding. "group"
+    # and "async" queue uploads in each worker to be written in batches by a background
+    # thread, and respond once the batch is committed ("group") or immediately ("async").
+    # Uploads queued in async mode are lost if the worker is killed. The buffered modes
+    # require threads to be enabled in uWSGI.
+    WRITE_DURABILITY: str = "sync"
+    # Write queued uploads every WRITE_FLUSH_INTERVAL seconds, or as soon as
+    # WRITE_FLUSH_ROWS readings are queued
+    WRITE_FLUSH_INTERVAL: float = 0.1
+    WRITE_FLUSH_ROWS: int = 5000
+    # Seconds that an upload waits to be committed in group mode before it fails with a 503.
+    # The readings may still be written after the timeout.
+    WRITE_WAIT_TIMEOUT: float = 30.0
+    # Maximum number of readings queued in each worker. Uploads are rejected with a 503
+    # while the queue is full.
+    WRITE_QUEUE_SIZE: int = 100_000
 
 
 @dataclass()
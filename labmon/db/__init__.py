@@ -1,5 +1,21 @@
 from .db import db
 from .fridges import Fridge, FridgeSupplementary
 from .sensors import Sensor, SensorSupplementary
+from .metadata import (
+    FridgeMetadata,
+    get_fleet_metadata,
+    get_fridge_metadata,
+    invalidate_metadata_cache,
+)
 
-__all__ = ["db", "Fridge", "FridgeSupplementary", "Sensor", "SensorSupplementary"]
+__all__ = [
+    "db",
+    "Fridge",
+    "FridgeSupplementary",
+    "Sensor",
+    "SensorSupplementary",
+    "FridgeMetadata",
+    "get_fleet_metadata",
+    "get_fridge_metadata",
+    "invalidate_metadata_cache",
+]
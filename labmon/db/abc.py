@@ -1,15 +1,16 @@
-from time import sleep
-from typing import Any
+from threading import Lock
+from typing import Any, Optional
 
 from sqlalchemy import TIMESTAMP, Column, Float, Integer, Unicode, UnicodeText, inspect
-from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import Mapped, declared_attr, mapped_column
 
 from .db import Base, db
 from .fridge_table import SensorReading
 
-# Cache of created fridge classes
+# Cache of created fridge classes, and the number of times each has been created
 _fridge_classes: dict[str, type[SensorReading]] = {}
+_fridge_class_versions: dict[str, int] = {}
+_fridge_classes_lock = Lock()
 
 
 class FridgeModel(Base):
@@ -20,6 +21,16 @@ class FridgeModel(Base):
     comment: Mapped[str] = mapped_column(UnicodeText)
     enabled: Mapped[bool] = mapped_column(Integer)
     view_order: Mapped[int] = mapped_column(Integer)
+    # Storage policies of the fridge table, as postgres intervals, or NULL to disable them.
+    # Chunks are compressed once older than compress_after, and raw readings older than
+    # retain_raw are dropped (the rollups are kept). These are only loaded when needed by
+    # labmon.manage, added by scripts/add_storage_policies.sql.
+    compress_after: Mapped[Optional[str]] = mapped_column(
+        Unicode(255), nullable=True, deferred=True, default=None, init=False
+    )
+    retain_raw: Mapped[Optional[str]] = mapped_column(
+        Unicode(255), nullable=True, deferred=True, default=None, init=False
+    )
 
     @declared_attr
     @classmethod
@@ -29,11 +40,14 @@ class FridgeModel(Base):
     def fridge_table(self, check_exists=True) -> type[SensorReading]:
         """
         Return a reference to the table associated with a fridge or
-        supplementary fridge dataset
+        supplementary fridge dataset. The table is recreated if the sensors of the fridge
+        have changed since it was created, for example by another process.
         """
-        # Check if we have an instance of the fridge table in cache
-        if self.table_name in _fridge_classes:
-            return _fridge_classes[self.table_name]
+        columns = {sensor.column_name for sensor in self.sensors}
+        # Check if we have an up to date instance of the fridge table in cache
+        cached = _fridge_classes.get(self.table_name)
+        if cached is not None and set(cached.sensor_names()) == columns:
+            return cached
 
         # double check that the table exists. We can ignore this check if
         # we are ignoring this for the purpose of creating the table.
@@ -48,30 +62,34 @@ class FridgeModel(Base):
                     )
                 )
 
-        # Otherwise we create an instance of the fridge table
-        # We have to fill in the annotations such that SQLAlchemy knows
-        # to map the columns to the dataclass
-        new_fridge_table: dict[str, Any] = {
-            "__tablename__": self.table_name,
-            "__annotations__": {"time": Column},
-            "time": mapped_column(TIMESTAMP(timezone=True), primary_key=True),
-        }
-        for sensor in self.sensors:
-            new_fridge_table["__annotations__"][sensor.column_name] = Column
-            new_fridge_table[sensor.column_name] = mapped_column(Float, nullable=True)
-        try:
-            fridge_class = type(self.table_name, (Base, SensorReading), new_fridge_table)
-        except InvalidRequestError as e:
-            # The table was created by another thread while we were working. Let's return
-            # the existing table instead
-            for _ in range(5):
-                sleep(0.01)
-                if self.table_name in _fridge_classes:
-                    return _fridge_classes[self.table_name]
-            raise RuntimeError(f"Couldn't create fridge class for {self.table_name}") from e
+        with _fridge_classes_lock:
+            # The table may have been created by another thread while we were waiting
+            cached = _fridge_classes.get(self.table_name)
+            if cached is not None:
+                if set(cached.sensor_names()) == columns:
+                    return cached
+                # Replace the table definition. The previous class keeps its own copy.
+                Base.metadata.remove(cached.__table__)
 
-        _fridge_classes[self.table_name] = fridge_class
-        return fridge_class
+            # Otherwise we create an instance of the fridge table
+            # We have to fill in the annotations such that SQLAlchemy knows
+            # to map the columns to the dataclass
+            new_fridge_table: dict[str, Any] = {
+                "__tablename__": self.table_name,
+                "__annotations__": {"time": Column},
+                "time": mapped_column(TIMESTAMP(timezone=True), primary_key=True),
+            }
+            for sensor in self.sensors:
+                new_fridge_table["__annotations__"][sensor.column_name] = Column
+                new_fridge_table[sensor.column_name] = mapped_column(Float, nullable=True)
+            # Each version of the class needs a unique name in the declarative registry
+            version = _fridge_class_versions.get(self.table_name, 0) + 1
+            class_name = self.table_name if version == 1 else f"{self.table_name}_v{version}"
+            fridge_class = type(class_name, (Base, SensorReading), new_fridge_table)
+
+            _fridge_class_versions[self.table_name] = version
+            _fridge_classes[self.table_name] = fridge_class
+            return fridge_class
 
 
 class SensorModel(Base):
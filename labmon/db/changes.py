@@ -0,0 +1,135 @@
+"""
+Log of the writes to each fridge table. Readings may be uploaded late, or changed after
+they are written by fill and merge uploads, so the time of the latest reading doesn't
+tell us whether older data has changed. Each write records the range of times that it
+touched, along with a new version of the table.
+
+Versions are taken from a counter row for each table, which stays locked until the write
+commits. Writes to a table therefore commit in the order of their versions, and a reader
+that has seen a version has also seen every earlier version.
+
+The tables are created by scripts/add_change_log.sql. Entries older than
+CHANGE_LOG_RETENTION are removed by python -m labmon.manage changes.
+"""
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import (
+    TIMESTAMP,
+    BigInteger,
+    Column,
+    Index,
+    MetaData,
+    Row,
+    Table,
+    Unicode,
+    and_,
+    delete,
+    exists,
+    func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .db import db
+
+# How long entries are kept in the change log
+CHANGE_LOG_RETENTION = timedelta(days=7)
+
+_change_metadata = MetaData()
+table_versions = Table(
+    "labmon_table_versions",
+    _change_metadata,
+    Column("table_name", Unicode(255), primary_key=True),
+    Column("version", BigInteger, nullable=False),
+    Column("changed", TIMESTAMP(timezone=True), nullable=False),
+)
+changes = Table(
+    "labmon_changes",
+    _change_metadata,
+    Column("table_name", Unicode(255), primary_key=True),
+    Column("version", BigInteger, primary_key=True),
+    Column("first_time", TIMESTAMP(timezone=True), nullable=False),
+    Column("last_time", TIMESTAMP(timezone=True), nullable=False),
+    Column("changed", TIMESTAMP(timezone=True), nullable=False),
+    Index("ix_labmon_changes_changed", "changed"),
+)
+
+
+def record_change(table_name: str, first_time: datetime, last_time: datetime):
+    """
+    Record a write to a fridge table touching readings between first_time and last_time,
+    as part of the current transaction. This locks the version of the table until the
+    transaction ends, so should be the last statement before committing.
+    """
+    # The time is read once the counter row is locked, so increases with the version
+    bump = pg_insert(table_versions).values(
+        table_name=table_name, version=1, changed=func.clock_timestamp()
+    )
+    bump = bump.on_conflict_do_update(
+        index_elements=["table_name"],
+        set_={"version": table_versions.c.version + 1, "changed": func.clock_timestamp()},
+    ).returning(table_versions.c.version, table_versions.c.changed)
+    version, changed = db.session.execute(bump).one()
+    db.session.execute(
+        changes.insert().values(
+            table_name=table_name,
+            version=version,
+            first_time=first_time,
+            last_time=last_time,
+            changed=changed,
+        )
+    )
+
+
+def get_version(table_name: str) -> Optional[Row]:
+    """
+    Return the version of a fridge table and the time it was written, or None if no
+    writes have been recorded
+    """
+    query = select(table_versions.c.version, table_versions.c.changed).where(
+        table_versions.c.table_name == table_name
+    )
+    return db.session.execute(query).one_or_none()
+
+
+def changed_between(
+    table_name: str,
+    version: int,
+    start: Optional[datetime] = None,
+    stop: Optional[datetime] = None,
+) -> bool:
+    """
+    Return whether any readings between start and stop were written after the given
+    version of a fridge table
+    """
+    conditions = [changes.c.table_name == table_name, changes.c.version > version]
+    if start is not None:
+        conditions.append(changes.c.last_time >= start)
+    if stop is not None:
+        conditions.append(changes.c.first_time <= stop)
+    return bool(db.session.scalar(select(exists().where(and_(*conditions)))))
+
+
+def earliest_change(table_name: str, version: int, before: datetime) -> Optional[datetime]:
+    """
+    Return the time of the earliest reading at or before the given time that was written
+    after the given version of a fridge table, or None if there is none
+    """
+    query = select(func.min(changes.c.first_time)).where(
+        changes.c.table_name == table_name,
+        changes.c.version > version,
+        changes.c.first_time <= before,
+    )
+    return db.session.scalar(query)
+
+
+def prune_changes(retention: timedelta = CHANGE_LOG_RETENTION) -> int:
+    """
+    Remove the entries of the change log older than retention. Returns the number of
+    entries removed.
+    """
+    removed = db.session.execute(delete(changes).where(changes.c.changed < func.now() - retention))
+    db.session.commit()
+    return removed.rowcount
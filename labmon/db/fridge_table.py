@@ -1,15 +1,156 @@
+import hashlib
+import json
+import logging
+from array import array
 from dataclasses import fields
-from datetime import datetime
-from typing import Iterable, Optional, dataclass_transform, TypeVar
+from datetime import datetime, timedelta
+from math import isinf, isnan
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Sequence,
+    dataclass_transform,
+    TypeVar,
+)
 
-from sqlalchemy import TIMESTAMP, Column, func, insert, select, Table
+from flask import current_app
+from psycopg import sql
+from sqlalchemy import (
+    ARRAY,
+    JSON,
+    TIMESTAMP,
+    Column,
+    ColumnElement,
+    Float,
+    Interval,
+    Row,
+    Select,
+    Table,
+    Unicode,
+    and_,
+    cast,
+    func,
+    literal,
+    or_,
+    select,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import array as pg_array
+from sqlalchemy.dialects.postgresql import Insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import aliased
-from sqlalchemy.exc import CompileError, IntegrityError
+from sqlalchemy.exc import CompileError, SQLAlchemyError
 
+from .changes import record_change
 from .db import db
+from .rollups import REFRESH_START, get_rollup, refresh_rollups
+
+logger = logging.getLogger(__name__)
 
 _T = TypeVar("_T")
 
+# Column oriented results: the times, and an array of values for each other column
+Columns = tuple[list[datetime], dict[str, array]]
+
+# Postgres limits the number of bind parameters in a single statement to 65535
+MAX_INSERT_PARAMS = 60_000
+
+# How to handle a reading whose timestamp already exists:
+#  - ignore: discard the new reading
+#  - fill: set sensors that are NULL in the existing reading from the new reading
+#  - merge: overwrite the sensors given in the new reading, keeping the others
+CONFLICT_MODES = ("ignore", "fill", "merge")
+
+# Fixed width buckets that data can be aggregated over, in addition to the calendar periods
+# which are truncated with date_trunc (and so follow the server timezone)
+BUCKET_WIDTHS = {
+    "10s": timedelta(seconds=10),
+    "1min": timedelta(minutes=1),
+    "5min": timedelta(minutes=5),
+    "15min": timedelta(minutes=15),
+}
+CALENDAR_PERIODS = ("hour", "day", "month")
+AVG_PERIODS = (*BUCKET_WIDTHS, *CALENDAR_PERIODS)
+# Approximate length of each period, from shortest to longest
+PERIOD_LENGTHS = {
+    **BUCKET_WIDTHS,
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "month": timedelta(days=30),
+}
+# Longest bucket of each period, allowing for daylight saving changes and long months
+MAX_PERIOD_LENGTHS = {
+    **BUCKET_WIDTHS,
+    "hour": timedelta(hours=1),
+    "day": timedelta(hours=25),
+    "month": timedelta(days=31, hours=1),
+}
+# Aggregates that can be calculated over each bucket. first and last require TimescaleDB.
+AGGREGATES = ("avg", "min", "max", "first", "last", "count")
+# Statistics calculated for each sensor by get_stats, in addition to percentiles
+STATISTICS = ("count", "min", "max", "mean", "stddev")
+# Postgres limits on the length of notification channel names and payloads, in bytes
+MAX_CHANNEL_LENGTH = 63
+MAX_NOTIFY_PAYLOAD = 7999
+# Readings that are ignored when calculating statistics
+INVALID_READINGS = (float("nan"), float("inf"), float("-inf"))
+
+
+def choose_period(span: timedelta, points: int) -> str:
+    """
+    Return the shortest period that splits a span of time into at most the given
+    number of buckets
+    """
+    for period, length in PERIOD_LENGTHS.items():
+        if span / length <= points:
+            return period
+    return CALENDAR_PERIODS[-1]
+
+
+def _bucket(time_period: str, time: ColumnElement) -> ColumnElement:
+    """
+    Return the start of the bucket that a time falls into for the given time period
+    """
+    if time_period in BUCKET_WIDTHS:
+        return func.time_bucket(_bucket_width(time_period), time)
+    return func.date_trunc(time_period, time)
+
+
+def _bucket_width(time_period: str) -> ColumnElement:
+    """
+    Return the width of the buckets for the given time period as an interval
+    """
+    if time_period in BUCKET_WIDTHS:
+        return literal(BUCKET_WIDTHS[time_period], Interval)
+    return cast(literal(f"1 {time_period}"), Interval)
+
+
+def _valid(value: ColumnElement, invalid: Sequence[float] = INVALID_READINGS) -> ColumnElement:
+    """
+    NULLIF each invalid value, so that they are ignored by aggregates
+    """
+    for invalid_value in invalid:
+        value = func.nullif(value, literal(invalid_value, Float))
+    return value
+
+
+def _time_literal(time: datetime) -> ColumnElement:
+    return literal(time, TIMESTAMP(timezone=True))
+
+
+def live_channel(table_name: str) -> str:
+    """
+    Return the name of the channel on which new readings for a table are published.
+    Channel names are limited in length, so long table names are replaced by a hash.
+    """
+    channel = f"labmon_{table_name}"
+    if len(channel.encode()) > MAX_CHANNEL_LENGTH:
+        channel = f"labmon_{hashlib.sha1(table_name.encode()).hexdigest()}"
+    return channel
+
 
 @dataclass_transform()
 def mark_dataclass(cls: type[_T]) -> type[_T]:
@@ -48,7 +189,74 @@ class SensorReading:
         return db.session.scalar(query)
 
     @classmethod
-    def append(cls, **values) -> bool:
+    def latest_time(cls) -> Optional[datetime]:
+        """
+        Return the time of the most recent reading, or None if there are no readings
+        """
+        query = select(func.max(cls.time))
+        return db.session.scalar(query)
+
+    @classmethod
+    def _upsert(cls, values: Sequence[Mapping[str, Any]], on_conflict: str = "ignore") -> Insert:
+        """
+        Build an insert of the given readings, which handles readings whose timestamp
+        already exists according to on_conflict (one of CONFLICT_MODES). The query
+        returns each reading that was inserted or changed, as it is stored.
+        """
+        table = cls.__table__
+        query = pg_insert(cls).values(values)
+        sensors = [column for column in values[0] if column != "time"]
+        if on_conflict == "ignore" or not sensors:
+            query = query.on_conflict_do_nothing(index_elements=["time"])
+        elif on_conflict == "fill":
+            # Only update rows where at least one NULL sensor gets filled in, so that
+            # replayed readings remain no-ops
+            query = query.on_conflict_do_update(
+                index_elements=["time"],
+                set_={name: func.coalesce(table.c[name], query.excluded[name]) for name in sensors},
+                where=or_(
+                    *(
+                        and_(table.c[name].is_(None), query.excluded[name].is_not(None))
+                        for name in sensors
+                    )
+                ),
+            )
+        elif on_conflict == "merge":
+            # Only update rows where at least one sensor changes
+            query = query.on_conflict_do_update(
+                index_elements=["time"],
+                set_={name: query.excluded[name] for name in sensors},
+                where=or_(
+                    *(table.c[name].is_distinct_from(query.excluded[name]) for name in sensors)
+                ),
+            )
+        else:
+            raise ValueError(f"Invalid conflict mode {on_conflict}")
+        return query.returning(*table.columns)
+
+    @staticmethod
+    def _combine_readings(
+        rows: Sequence[Mapping[str, Any]], on_conflict: str
+    ) -> list[dict[str, Any]]:
+        """
+        Combine readings that share a timestamp, in the same way as they would be combined
+        with an existing reading. Postgres can't update the same row twice in one insert.
+        """
+        combined: dict[datetime, dict[str, Any]] = {}
+        for row in rows:
+            reading = combined.setdefault(row["time"], {})
+            for name, value in row.items():
+                if on_conflict == "merge" or reading.get(name) is None:
+                    reading[name] = value
+        return list(combined.values())
+
+    @classmethod
+    def append(cls, on_conflict: str = "ignore", **values) -> bool:
+        """
+        Insert a single reading, at the current time if no time is given. Returns whether
+        the reading was stored, or False if its timestamp already exists and the reading
+        was handled according to on_conflict (one of CONFLICT_MODES) without changes.
+        """
         # Handle both "Time" and "time" for legacy reasons
         if "Time" in values:
             time = values["Time"]
@@ -60,55 +268,395 @@ class SensorReading:
             time = datetime.now().astimezone()
 
         try:
-            query = insert(cls).values(time=time, **values)
-            db.session.execute(query)
+            stored = db.session.execute(cls._upsert([{"time": time, **values}], on_conflict))
+            reading = stored.mappings().one_or_none()
+            if reading is not None:
+                cls._notify(reading)
+                record_change(cls.__table__.name, reading["time"], reading["time"])
             db.session.commit()
-            return True
         except CompileError as exc:
+            db.session.rollback()
             raise KeyError("Invalid column name") from exc
-        except IntegrityError:
-            # This occurs if we try and add a duplicate timestamp
-            # We can fail quietly here
-            return False
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        if reading is not None:
+            cls._refresh_rollups(reading["time"], reading["time"])
+        return reading is not None
 
     @classmethod
-    def get_last(cls, n: int = 1) -> Iterable["SensorReading"]:
+    def append_many(cls, rows: Sequence[Mapping[str, Any]], on_conflict: str = "ignore") -> int:
+        """
+        Insert many readings in a single transaction. Each reading must contain a time.
+        Readings whose timestamp already exists are handled according to on_conflict
+        (one of CONFLICT_MODES).
+        Returns the number of readings that were inserted or changed.
+        """
+        if not rows:
+            return 0
+        if on_conflict != "ignore":
+            rows = cls._combine_readings(rows, on_conflict)
+
+        # Each row of a multi-row insert must contain the same columns, so fill in
+        # any missing sensors with NULL. When merging, NULL would overwrite the existing
+        # values, so instead readings are inserted separately for each set of sensors.
+        groups: dict[frozenset[str], list[Mapping[str, Any]]] = {}
+        if on_conflict == "merge":
+            for row in rows:
+                groups.setdefault(frozenset(row), []).append(row)
+        else:
+            groups[frozenset(["time"]).union(*rows)] = list(rows)
+
+        stored: list[Mapping[str, Any]] = []
+        try:
+            for columns, group in groups.items():
+                values = [{column: row.get(column) for column in columns} for row in group]
+                batch_size = max(1, MAX_INSERT_PARAMS // len(columns))
+                for i in range(0, len(values), batch_size):
+                    query = cls._upsert(values[i : i + batch_size], on_conflict)
+                    stored.extend(db.session.execute(query).mappings())
+            if stored:
+                # Only publish the newest reading to live clients
+                cls._notify(max(stored, key=lambda reading: reading["time"]))
+                times = [reading["time"] for reading in stored]
+                record_change(cls.__table__.name, min(times), max(times))
+            db.session.commit()
+        except CompileError as exc:
+            db.session.rollback()
+            raise KeyError("Invalid column name") from exc
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        if stored:
+            cls._refresh_rollups(min(times), max(times))
+        return len(stored)
+
+    @classmethod
+    def _refresh_rollups(cls, first_time: datetime, last_time: datetime):
+        """
+        Refresh the rollups over readings written between first_time and last_time, if
+        they are too old to be refreshed in the background. The readings have already
+        been committed, so errors are logged rather than raised.
+        """
+        if first_time > datetime.now(first_time.tzinfo) - REFRESH_START:
+            return
+        try:
+            refresh_rollups(cls, first_time, last_time)
+        except SQLAlchemyError:
+            logger.exception("Failed to refresh the rollups of %s", cls.__table__.name)
+
+    @classmethod
+    def _notify(cls, reading: Mapping[str, Any]):
+        """
+        Publish a new reading to clients listening for live updates on this table.
+        The notification is sent when the current transaction commits. Readings too large
+        to send are published as just their time, marked as truncated, and clients can
+        fetch the full reading with ?since.
+        """
+        if not current_app.config.get("LIVE_UPDATES", False):
+            return
+        payload = {}
+        for name, value in reading.items():
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, float) and (isnan(value) or isinf(value)):
+                value = None
+            payload[name] = value
+        message = json.dumps(payload)
+        if len(message.encode()) > MAX_NOTIFY_PAYLOAD:
+            message = json.dumps({"time": payload.get("time"), "truncated": True})
+        channel = live_channel(cls.__table__.name)
+        db.session.execute(select(func.pg_notify(channel, message)))
+
+    @classmethod
+    def sensor_names(cls) -> list[str]:
+        """
+        Return the names of the sensor columns of the table
+        """
+        return [field.name for field in fields(cls) if field.name != "time"]
+
+    @classmethod
+    def _select(cls, columns: Optional[Sequence[str]] = None) -> Select:
+        """
+        Select the time and each sensor column, or only the given sensor columns
+        """
+        table = cls.__table__
+        names = cls.sensor_names() if columns is None else columns
+        return select(table.c.time, *(table.c[name] for name in names))
+
+    @classmethod
+    def _ascending(
+        cls,
+        query: Select,
+        columns: Optional[Sequence[str]] = None,
+        yield_per: Optional[int] = None,
+    ) -> Iterable[Any]:
+        """
+        Reorder the results of a query ascending by time. If only some columns were
+        selected, rows containing the time and those columns are returned rather than
+        readings.
+        """
+        if columns is None:
+            subq = aliased(cls, query.subquery(), adapt_on_names=True)
+            ordered_query = select(subq).order_by(subq.time.asc())
+        else:
+            subq = query.subquery()
+            ordered_query = select(subq).order_by(subq.c.time.asc())
+        if yield_per is not None:
+            ordered_query = ordered_query.execution_options(yield_per=yield_per)
+        res = db.session.execute(ordered_query)
+        return res.scalars() if columns is None else res
+
+    @classmethod
+    def read_columns(cls, query: Select, batch_size: int = 10_000) -> Columns:
+        """
+        Run a query for the time and some other columns, and return the results ordered
+        by time ascending as a list of times and an array of values for each other column.
+        Missing values are stored as NaN.
+        Rows are read as plain tuples in batches of batch_size, so no readings are
+        constructed and only one batch of rows is held in memory at a time.
+        """
+        names, ordered_query = cls._ordered_columns(query)
+        times: list[datetime] = []
+        data = {name: array("d") for name in names}
+        for batch_times, batch_data in cls._read_batches(ordered_query, names, batch_size):
+            times.extend(batch_times)
+            for name, values in batch_data.items():
+                data[name].extend(values)
+        return times, data
+
+    @classmethod
+    def iter_columns(cls, query: Select, batch_size: int = 10_000) -> Iterator[Columns]:
+        """
+        Run a query as for read_columns, but yield each batch of rows as columns as it
+        is read, so that arbitrarily large results can be processed in bounded memory.
+        """
+        names, ordered_query = cls._ordered_columns(query)
+        yield from cls._read_batches(ordered_query, names, batch_size)
+
+    @classmethod
+    def _ordered_columns(cls, query: Select) -> tuple[list[str], Select]:
+        subq = query.subquery()
+        names = [str(column.name) for column in subq.c if column.name != "time"]
+        ordered_query = select(subq.c.time, *(subq.c[name] for name in names))
+        return names, ordered_query.order_by(subq.c.time.asc())
+
+    @classmethod
+    def _read_batches(
+        cls, ordered_query: Select, names: list[str], batch_size: int
+    ) -> Iterator[Columns]:
+        nan = float("nan")
+        ordered_query = ordered_query.execution_options(yield_per=batch_size)
+        for batch in db.session.execute(ordered_query).partitions():
+            batch_columns = list(zip(*batch))
+            data = {}
+            for name, batch_values in zip(names, batch_columns[1:]):
+                data[name] = array("d", (nan if val is None else val for val in batch_values))
+            yield list(batch_columns[0]), data
+
+    @classmethod
+    def get_last(
+        cls, n: int = 1, columns: Optional[Sequence[str]] = None
+    ) -> Iterable["SensorReading"]:
         """
         Return the most recent `n` sensor readings. If n is greater than the number
         of readings stored, return the all the readings.
+        If columns is given, only those sensors are read (see _ascending).
+        """
+        return cls._ascending(cls._last_query(n, columns), columns)
+
+    @classmethod
+    def get_last_columns(cls, n: int = 1, columns: Optional[Sequence[str]] = None) -> Columns:
+        """
+        Return the most recent `n` sensor readings, as columns (see read_columns)
         """
+        return cls.read_columns(cls._last_query(n, columns))
+
+    @classmethod
+    def _last_query(cls, n: int, columns: Optional[Sequence[str]] = None) -> Select:
         if n <= 0:
             raise ValueError(f"n must be a positive integer. Got {n}.")
-        query = select(cls).order_by(cls.time.desc()).limit(n)
-        subq = aliased(cls, query.subquery())
-        ordered_query = select(subq).order_by(subq.time.asc())
-        res = db.session.execute(ordered_query)
-        return res.scalars()
+        return cls._select(columns).order_by(cls.time.desc()).limit(n)
 
     @classmethod
-    def get_between(
-        cls, start: Optional[datetime] = None, stop: Optional[datetime] = None
-    ) -> Iterable["SensorReading"]:
+    def get_since_columns(
+        cls, since: datetime, n: int, columns: Optional[Sequence[str]] = None
+    ) -> Columns:
         """
-        Return sensor readings taken between the start and stop times
+        Return the first `n` sensor readings taken strictly after the given time, as
+        columns (see read_columns)
+        """
+        return cls.read_columns(cls._since_query(since, n, columns))
+
+    @classmethod
+    def _since_query(
+        cls, since: datetime, n: int, columns: Optional[Sequence[str]] = None
+    ) -> Select:
+        if n <= 0:
+            raise ValueError(f"n must be a positive integer. Got {n}.")
+        return cls._select(columns).where(cls.time > since).order_by(cls.time.asc()).limit(n)
+
+    @classmethod
+    def _where_between(
+        cls, query: Select, start: Optional[datetime] = None, stop: Optional[datetime] = None
+    ) -> Select:
+        """
+        Restrict a query to readings taken between the start and stop times
         """
-        # Construct the correct select query
-        query = select(cls)
         if start is not None and stop is not None:
-            query = query.where(cls.time.between(start, stop))
-        elif start is not None:
-            query = query.where(cls.time > start)
-        elif stop is not None:
-            query = query.where(cls.time < stop)
-        else:
-            raise ValueError("Either start, stop or both must be given")
-        query = query.order_by(cls.time.desc())
+            return query.where(cls.time.between(start, stop))
+        if start is not None:
+            return query.where(cls.time > start)
+        if stop is not None:
+            return query.where(cls.time < stop)
+        raise ValueError("Either start, stop or both must be given")
+
+    @classmethod
+    def count_between(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        limit: Optional[int] = None,
+    ) -> int:
+        """
+        Return the number of readings taken between the start and stop times. If limit
+        is given, at most limit readings are counted, bounding the cost of the count.
+        """
+        query = cls._where_between(select(cls.time), start, stop)
+        if limit is not None:
+            query = query.limit(limit)
+        count = select(func.count()).select_from(query.subquery())  # pylint: disable=not-callable
+        return db.session.scalar(count)
 
+    @classmethod
+    def get_between(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        yield_per: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Iterable["SensorReading"]:
+        """
+        Return sensor readings taken between the start and stop times.
+        If yield_per is given, rows are fetched in batches of that size using a
+        server-side cursor rather than being loaded all at once.
+        If columns is given, only those sensors are read (see _ascending).
+        """
         # Order data by time ascending
-        subq = aliased(cls, query.subquery())
-        ordered_query = select(subq).order_by(subq.time.asc())
-        res = db.session.execute(ordered_query)
-        return res.scalars()
+        return cls._ascending(cls._between_query(start, stop, columns), columns, yield_per)
+
+    @classmethod
+    def get_between_columns(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Columns:
+        """
+        Return sensor readings taken between the start and stop times, as columns
+        (see read_columns)
+        """
+        return cls.read_columns(cls._between_query(start, stop, columns))
+
+    @classmethod
+    def _between_query(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Select:
+        query = cls._where_between(cls._select(columns), start, stop)
+        return query.order_by(cls.time.desc())
+
+    @classmethod
+    def get_page_columns(
+        cls,
+        start: datetime,
+        stop: datetime,
+        limit: int,
+        after: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Columns:
+        """
+        Return a page of up to `limit` sensor readings taken between the start and stop
+        times, and strictly after `after` if given, as columns (see read_columns).
+        Pass the time of the last reading of a page as `after` to fetch the next page.
+        Each page is a bounded range scan of the time index, no matter how far through
+        the range it is.
+        """
+        if limit <= 0:
+            raise ValueError(f"limit must be a positive integer. Got {limit}.")
+        query = cls._select(columns).where(cls.time.between(start, stop))
+        if after is not None:
+            query = query.where(cls.time > after)
+        return cls.read_columns(query.order_by(cls.time.asc()).limit(limit))
+
+    @classmethod
+    def _export_query(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Select:
+        query = cls._select(columns)
+        if start is not None:
+            query = query.where(cls.time >= start)
+        if stop is not None:
+            query = query.where(cls.time <= stop)
+        return query
+
+    @classmethod
+    def export_columns(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+        batch_size: int = 10_000,
+    ) -> Iterator[Columns]:
+        """
+        Yield the sensor readings taken between the start and stop times (or all
+        readings if they aren't given) in batches of columns (see iter_columns).
+        """
+        return cls.iter_columns(cls._export_query(start, stop, columns), batch_size)
+
+    @classmethod
+    def export_csv(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Iterator[bytes]:
+        """
+        Yield the sensor readings taken between the start and stop times (or all
+        readings if they aren't given) as CSV with a header row. The rows are copied
+        out of the database with COPY TO STDOUT, so are streamed without being
+        processed by python. Requires a psycopg connection.
+        """
+        names = ["time", *(cls.sensor_names() if columns is None else columns)]
+        conditions = []
+        if start is not None:
+            conditions.append(sql.SQL("time >= {}").format(sql.Literal(start)))
+        if stop is not None:
+            conditions.append(sql.SQL("time <= {}").format(sql.Literal(stop)))
+        where = sql.SQL("")
+        if conditions:
+            where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+        statement = sql.SQL(
+            "COPY (SELECT {} FROM {}{} ORDER BY time) TO STDOUT WITH (FORMAT csv, HEADER)"
+        ).format(
+            sql.SQL(", ").join(sql.Identifier(name) for name in names),
+            sql.Identifier(cls.__table__.name),
+            where,
+        )
+
+        conn = db.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                with cursor.copy(statement) as copy:
+                    for data in copy:
+                        yield bytes(data)
+        finally:
+            conn.close()
 
     @classmethod
     def hourly_avg(
@@ -123,6 +671,46 @@ class SensorReading:
         """
         return cls.avg_data("hour", start, stop, count)
 
+    @classmethod
+    def _bucketed(
+        cls,
+        time_period: str,
+        time: ColumnElement,
+        dategroup: ColumnElement,
+        table_fields: list[ColumnElement],
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+        grouped: bool = True,
+    ) -> Select:
+        """
+        Construct a query for the fields of each bucket between start and stop, newest
+        first, limited to the latest count buckets.
+        The range is filtered on the time column itself rather than the bucket, with the
+        bounds aligned to the buckets, so that the time index can be used to find only
+        the readings that are needed.
+        """
+        dategroup = dategroup.label("time")
+        dategroup.type = TIMESTAMP(timezone=True)
+
+        # Construct the query
+        query = select(dategroup, *table_fields)
+        if start is not None:
+            query = query.where(time >= _bucket(time_period, _time_literal(start)))
+        if stop is not None:
+            stop_bound = _bucket(time_period, _time_literal(stop)) + _bucket_width(time_period)
+            query = query.where(time < stop_bound)
+        if count is not None:
+            # Only read back as far as the start of the earliest bucket
+            latest = select(func.max(time)).scalar_subquery()
+            if stop is not None:
+                latest = select(func.max(time)).where(time < stop_bound).scalar_subquery()
+            lower_bound = _bucket(time_period, latest) - _bucket_width(time_period) * (count - 1)
+            query = query.where(time >= lower_bound).limit(count)
+        if grouped:
+            query = query.group_by(dategroup)
+        return query.order_by(dategroup.desc())
+
     @classmethod
     def avg_data(
         cls,
@@ -130,34 +718,227 @@ class SensorReading:
         start: Optional[datetime] = None,
         stop: Optional[datetime] = None,
         count: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
     ) -> Iterable["SensorReading"]:
         """
         Averaged data over a time period given by time_period
-        This can be "hour", "day", or "month" (or year but this is kind of useless)
-        TODO: Rewrite for timescaledb functions
+        This can be any of AVG_PERIODS, i.e. a fixed width bucket such as "5min", or
+        "hour", "day", or "month".
+        Averages are read from the hourly or daily rollups of the table where they exist.
+        If columns is given, only those sensors are averaged (see _ascending).
         """
-        dategroup = func.date_trunc(time_period, cls.time).label("time")
-        dategroup.type = TIMESTAMP(timezone=True)
-        table_fields = []
-        for field in fields(cls):
-            name = field.name
-            if name == "time":
-                continue
-            table_fields.append(func.avg(getattr(cls, name)).label(name))
+        query = cls._avg_query(time_period, start, stop, count, columns)
+        return cls._ascending(query, columns)
 
-        # Construct the query
-        query = select(dategroup, *table_fields)
-        if start is not None and stop is not None:
-            query = query.where(dategroup.between(start, stop))
-        elif start is not None:
-            query = query.where(dategroup > start)
-        elif stop is not None:
-            query = query.where(dategroup < stop)
+    @classmethod
+    def avg_data_columns(
+        cls,
+        time_period: str = "hour",
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Columns:
+        """
+        Averaged data over a time period (see avg_data), as columns (see read_columns)
+        """
+        return cls.read_columns(cls._avg_query(time_period, start, stop, count, columns))
+
+    @classmethod
+    def _avg_query(
+        cls,
+        time_period: str,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Select:
+        names = cls.sensor_names() if columns is None else list(columns)
+
+        # Read from the precomputed rollups if they exist, otherwise average the raw data.
+        # Sensors added since the rollup was created are averaged from the raw data.
+        rollup = get_rollup(cls, time_period)
+        rolled_up = [] if rollup is None else [name for name in names if name in rollup.sensors]
+        raw = [name for name in names if name not in rolled_up]
+        queries = []
+        if rollup is not None and rolled_up:
+            dategroup, table_fields, grouped = rollup.averages(time_period, rolled_up)
+            queries.append(
+                cls._bucketed(
+                    time_period,
+                    rollup.table.c.time,
+                    dategroup,
+                    table_fields,
+                    start,
+                    stop,
+                    count,
+                    grouped,
+                )
+            )
+        if raw or not queries:
+            dategroup = _bucket(time_period, cls.time)
+            table_fields = [func.avg(getattr(cls, name)).label(name) for name in raw]
+            queries.append(
+                cls._bucketed(time_period, cls.time, dategroup, table_fields, start, stop, count)
+            )
+        if len(queries) == 1:
+            return queries[0]
+
+        # Join the averages from the rollup and the raw data on the start of each bucket
+        rolled, averaged = (query.subquery() for query in queries)
+        time = func.coalesce(rolled.c.time, averaged.c.time)
+        query = (
+            select(
+                time.label("time"),
+                *(rolled.c[name] if name in rolled_up else averaged.c[name] for name in names),
+            )
+            .select_from(rolled.join(averaged, rolled.c.time == averaged.c.time, full=True))
+            .order_by(time.desc())
+        )
         if count is not None:
             query = query.limit(count)
-        query = query.group_by(dategroup).order_by(dategroup.desc())
+        return query
 
-        subq = aliased(cls, alias=query.subquery(), adapt_on_names=True)
-        ordered_query = select(subq).order_by(subq.time)
-        res = db.session.execute(ordered_query)
-        return res.scalars()
+    @classmethod
+    def aggregate_data_columns(
+        cls,
+        time_period: str,
+        aggregates: Sequence[str],
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Columns:
+        """
+        Aggregate each sensor (or each of the given columns) over buckets of the given
+        time period (as for avg_data), using each of the given AGGREGATES. Returns the
+        start of each bucket, and a column named "<sensor>_<aggregate>" for each sensor and
+        aggregate (see read_columns).
+        """
+        query = cls._aggregate_query(time_period, aggregates, start, stop, count, columns)
+        return cls.read_columns(query)
+
+    @classmethod
+    def _aggregate_query(
+        cls,
+        time_period: str,
+        aggregates: Sequence[str],
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> Select:
+        table_fields = []
+        for name in cls.sensor_names() if columns is None else columns:
+            column = getattr(cls, name)
+            for aggregate in aggregates:
+                if aggregate in ("first", "last"):
+                    value = getattr(func, aggregate)(column, cls.time, type_=Float)
+                elif aggregate in ("min", "max"):
+                    # NaN sorts above every other value, so would hide the true maximum
+                    value = getattr(func, aggregate)(
+                        func.nullif(column, literal(float("nan"), Float))
+                    )
+                else:
+                    value = getattr(func, aggregate)(column)
+                table_fields.append(value.label(f"{name}_{aggregate}"))
+        dategroup = _bucket(time_period, cls.time)
+        return cls._bucketed(time_period, cls.time, dategroup, table_fields, start, stop, count)
+
+    @classmethod
+    def get_minimum(
+        cls,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        time_period: Optional[str] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> list[Optional[float]]:
+        """
+        Return the minimum reading across all sensors (or the given columns) for each
+        reading taken between the start and stop times, ignoring NaN, infinite or zero
+        readings. If a time period is given, the minimums are averaged over that time period.
+        """
+        # NULLIF each invalid value, which are then ignored by LEAST
+        values = []
+        for name in cls.sensor_names() if columns is None else columns:
+            values.append(_valid(getattr(cls, name), (0.0, *INVALID_READINGS)))
+        if not values:
+            values.append(literal(None, Float))
+        minimum = func.least(*values)
+
+        if time_period is None:
+            query = cls._where_between(select(minimum), start, stop).order_by(cls.time.asc())
+        else:
+            dategroup = _bucket(time_period, cls.time).label("time")
+            query = cls._where_between(select(func.avg(minimum), dategroup), start, stop)
+            query = query.group_by(dategroup).order_by(dategroup.asc())
+        return list(db.session.scalars(query))
+
+    @classmethod
+    def get_stats(
+        cls,
+        start: datetime,
+        stop: datetime,
+        time_period: Optional[str] = None,
+        columns: Optional[Sequence[str]] = None,
+        percentiles: Sequence[float] = (0.05, 0.5, 0.95),
+    ) -> Sequence[Row]:
+        """
+        Calculate the STATISTICS and the given percentiles (as fractions) of each sensor
+        (or the given columns) over the readings taken between the start and stop times,
+        ignoring NaN or infinite readings. If a time period is given, the statistics are
+        calculated for each bucket of the time period.
+        Returns a row for each bucket, containing the time (if bucketed), and for each
+        sensor the columns "<sensor>_<statistic>" and "<sensor>_percentiles", an array of
+        the percentiles in the order they were given.
+        """
+        table_fields = []
+        for name in cls.sensor_names() if columns is None else columns:
+            value = _valid(getattr(cls, name))
+            table_fields.extend(
+                [
+                    func.count(value).label(f"{name}_count"),  # pylint: disable=not-callable
+                    func.min(value).label(f"{name}_min"),
+                    func.max(value).label(f"{name}_max"),
+                    func.avg(value).label(f"{name}_mean"),
+                    func.stddev_samp(value).label(f"{name}_stddev"),
+                    func.percentile_cont(pg_array(list(percentiles)), type_=ARRAY(Float))
+                    .within_group(value)
+                    .label(f"{name}_percentiles"),
+                ]
+            )
+
+        if time_period is None:
+            query = select(*table_fields).where(cls.time.between(start, stop))
+        else:
+            dategroup = _bucket(time_period, cls.time).label("time")
+            dategroup.type = TIMESTAMP(timezone=True)
+            query = select(dategroup, *table_fields).where(cls.time.between(start, stop))
+            query = query.group_by(dategroup).order_by(dategroup.asc())
+        return db.session.execute(query).all()
+
+
+def get_last_many(tables: Iterable[type[SensorReading]]) -> dict[str, Optional[dict[str, Any]]]:
+    """
+    Return the most recent reading from each of the given tables in a single query,
+    keyed by table name. Each reading is returned as a dictionary mapping column name
+    to value, or None if the table is empty.
+    """
+    latest_readings: dict[str, Optional[dict[str, Any]]] = {}
+    queries = []
+    for table in tables:
+        table_name = table.__table__.name
+        latest_readings[table_name] = None
+        latest = select(table).order_by(table.time.desc()).limit(1).subquery()
+        queries.append(
+            select(
+                literal(table_name, Unicode).label("table_name"),
+                func.row_to_json(latest.table_valued(), type_=JSON).label("reading"),
+            )
+        )
+    if not queries:
+        return latest_readings
+
+    for table_name, reading in db.session.execute(union_all(*queries)):
+        latest_readings[table_name] = reading
+    return latest_readings
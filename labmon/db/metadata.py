@@ -0,0 +1,162 @@
+"""
+Per-process cache of fridge metadata. Looking up a fridge, its supplementary tables and
+their sensors costs several queries, but this metadata changes rarely. We cache an immutable
+copy of the metadata for a short time, and clear the cache whenever the metadata tables
+are modified through this process. Changes made by other processes, such as scripts adding
+sensors, are picked up once the cached copy expires, and the fridge table is then recreated
+with the new sensors.
+"""
+
+import logging
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional, TypeVar
+
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import selectinload
+
+from .abc import FridgeModel
+from .db import db
+from .fridge_table import SensorReading
+from .fridges import Fridge, FridgeSupplementary
+from .sensors import Sensor, SensorSupplementary
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+# Cache of metadata, keyed by (fridge name, supplementary name) or _FLEET_KEY, along
+# with the time at which it was loaded
+_metadata_cache: dict[Hashable, tuple[float, Any]] = {}
+_metadata_lock = Lock()
+_FLEET_KEY = object()
+
+
+@dataclass(frozen=True)
+class SensorMetadata:
+    column_name: str
+    display_name: str
+    view_order: int
+    visible: bool
+
+
+@dataclass(frozen=True)
+class FridgeMetadata:
+    """
+    Detached copy of the metadata for a fridge or supplementary fridge dataset
+    """
+
+    name: str
+    label: str
+    table_name: str
+    enabled: bool
+    view_order: int
+    sensors: tuple[SensorMetadata, ...]
+    table: type[SensorReading]
+
+    @classmethod
+    def from_model(cls, model: FridgeModel) -> "FridgeMetadata":
+        sensors = tuple(
+            SensorMetadata(
+                column_name=sensor.column_name,
+                display_name=sensor.display_name,
+                view_order=sensor.view_order,
+                visible=bool(sensor.visible),
+            )
+            for sensor in model.sensors
+        )
+        return cls(
+            name=model.name,
+            label=model.label,
+            table_name=model.table_name,
+            enabled=bool(model.enabled),
+            view_order=model.view_order,
+            sensors=sensors,
+            table=model.fridge_table(),
+        )
+
+    def fridge_table(self) -> type[SensorReading]:
+        """
+        Return a reference to the table associated with the fridge
+        """
+        return self.table
+
+
+def _get_cached(key: Hashable, loader: Callable[[], _T]) -> _T:
+    """
+    Return the cached value for key if it hasn't expired, otherwise load and cache it
+    """
+    ttl = current_app.config.get("METADATA_CACHE_TTL", 0)
+    cached = _metadata_cache.get(key)
+    if cached is not None and monotonic() - cached[0] < ttl:
+        return cached[1]
+
+    value = loader()
+    with _metadata_lock:
+        _metadata_cache[key] = (monotonic(), value)
+    return value
+
+
+def get_fridge_metadata(fridge_name: str, supp: Optional[str] = None) -> FridgeMetadata:
+    """
+    Return the metadata for a fridge, or a supplementary dataset of the fridge if supp
+    is given. Raises a KeyError if the fridge can't be found.
+    """
+
+    def load() -> FridgeMetadata:
+        fridge = Fridge.get_fridge_by_name(fridge_name)
+        if supp is not None:
+            return FridgeMetadata.from_model(
+                FridgeSupplementary.get_fridge_supp_by_name(fridge, supp)
+            )
+        return FridgeMetadata.from_model(fridge)
+
+    return _get_cached((fridge_name, supp), load)
+
+
+def get_fleet_metadata() -> list[tuple[FridgeMetadata, tuple[FridgeMetadata, ...]]]:
+    """
+    Return the metadata for every enabled fridge, along with each of its enabled
+    supplementary datasets. Fridges whose tables are missing are skipped.
+    """
+
+    def load() -> list[tuple[FridgeMetadata, tuple[FridgeMetadata, ...]]]:
+        query = (
+            select(Fridge)
+            .where(Fridge.enabled != 0)
+            .order_by(Fridge.view_order)
+            .options(
+                selectinload(Fridge.sensors),
+                selectinload(Fridge.supplementary).selectinload(FridgeSupplementary.sensors),
+            )
+        )
+        fleet = []
+        for fridge in db.session.scalars(query):
+            try:
+                supps = tuple(
+                    FridgeMetadata.from_model(supp)
+                    for supp in sorted(fridge.supplementary, key=lambda supp: supp.view_order or 0)
+                    if supp.enabled
+                )
+                fleet.append((FridgeMetadata.from_model(fridge), supps))
+            except KeyError as e:
+                logger.warning("Skipping fridge %s: %s", fridge.name, e)
+        return fleet
+
+    return _get_cached(_FLEET_KEY, load)
+
+
+def invalidate_metadata_cache(*_args):
+    """
+    Clear all cached fridge metadata
+    """
+    with _metadata_lock:
+        _metadata_cache.clear()
+
+
+# Clear the cache whenever the metadata tables are changed
+for _model in (Fridge, FridgeSupplementary, Sensor, SensorSupplementary):
+    for _event in ("after_insert", "after_update", "after_delete"):
+        event.listen(_model, _event, invalidate_metadata_cache)
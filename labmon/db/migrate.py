@@ -0,0 +1,399 @@
+"""
+Online migration of a fridge table into a new table, by default a TimescaleDB hypertable
+partitioned by month. Rows are copied in time ordered chunks, each in its own transaction,
+and the progress is recorded in a checkpoint table so that an interrupted migration
+resumes where it left off. Uploads continue to the source table while it is copied.
+Writes to rows that have already been copied, either late uploads or fill and merge
+uploads, are found in the change log and copied again after each chunk. Versions in the
+change log become visible in order, so every change after the last version replayed is
+still to be copied.
+
+Once the copy has caught up, the source table is locked against writes while the last
+rows and changes are copied, and the new table is renamed into place. The storage
+policies of the fridge table are then moved to the new table, and its rollups are
+recreated. The source table and its rollups are kept with the suffix OLD_SUFFIX until
+they are dropped by hand, as the old rollups hold the averages of raw data that was
+dropped by the retention policy.
+
+Requires the change log (scripts/add_change_log.sql) and the storage policy columns of
+the fridges (scripts/add_storage_policies.sql).
+"""
+
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Optional
+
+from sqlalchemy import (
+    TIMESTAMP,
+    BigInteger,
+    Column,
+    Connection,
+    MetaData,
+    Table,
+    Unicode,
+    delete,
+    func,
+    inspect,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .changes import changes, table_versions
+from .db import db
+from .rollups import ROLLUP_PERIODS, create_rollups, rename_rollups, rollup_name
+from .storage import apply_storage_policies, is_hypertable
+
+if TYPE_CHECKING:
+    from .fridge_table import SensorReading
+
+logger = logging.getLogger(__name__)
+
+SHADOW_SUFFIX = "__migrating"
+OLD_SUFFIX = "__old"
+# Chunk interval of the new hypertable
+CHUNK_INTERVAL = "1 month"
+
+_migration_metadata = MetaData()
+migrations = Table(
+    "labmon_migrations",
+    _migration_metadata,
+    Column("table_name", Unicode(255), primary_key=True),
+    Column("source", Unicode(255), nullable=False),
+    Column("copied_until", TIMESTAMP(timezone=True), nullable=True),
+    Column("rows_copied", BigInteger, nullable=False, default=0),
+    # Version of the source table up to which changes have been copied
+    Column("replayed_version", BigInteger, nullable=False, default=0),
+    Column("started", TIMESTAMP(timezone=True), nullable=False),
+    Column("finished", TIMESTAMP(timezone=True), nullable=True),
+)
+
+
+def _create_shadow(fridge_table: type["SensorReading"], shadow_name: str, hypertable: bool):
+    """
+    Create the table that the data is copied into, with the columns of the fridge table
+    """
+    shadow = fridge_table.__table__.to_metadata(MetaData(), name=shadow_name)
+    with db.engine.begin() as conn:
+        shadow.drop(conn, checkfirst=True)
+        shadow.create(conn)
+        if hypertable:
+            conn.execute(
+                text(
+                    "SELECT create_hypertable(CAST(:t AS REGCLASS), "
+                    "by_range('time', CAST(:interval AS INTERVAL)))"
+                ),
+                {"t": f'"{shadow_name}"', "interval": CHUNK_INTERVAL},
+            )
+
+
+def _copy_rows(
+    conn: Connection,
+    source: Table,
+    shadow: Table,
+    after: Optional[datetime],
+    until: Optional[datetime] = None,
+    overwrite: bool = False,
+) -> int:
+    """
+    Copy the rows of source after (and not including) the time after, up to and including
+    until. Rows that have already been copied are skipped, or replaced if overwrite is set.
+    Returns the number of rows copied.
+    """
+    time = source.c.time if "time" in source.c else source.c.Time
+    sensors = [column.name for column in shadow.columns if column.name in source.c]
+    sensors.remove("time")
+    query = select(time, *(source.c[name] for name in sensors))
+    if after is not None:
+        query = query.where(time > after)
+    if until is not None:
+        query = query.where(time <= until)
+    insert_query = pg_insert(shadow).from_select(["time", *sensors], query.order_by(time))
+    if overwrite and sensors:
+        insert_query = insert_query.on_conflict_do_update(
+            index_elements=["time"],
+            set_={name: insert_query.excluded[name] for name in sensors},
+        )
+    else:
+        insert_query = insert_query.on_conflict_do_nothing(index_elements=["time"])
+    return conn.execute(insert_query).rowcount
+
+
+@dataclass
+class _Progress:
+    """
+    Progress of a migration, as recorded in the checkpoint table
+    """
+
+    copied_until: Optional[datetime]
+    rows_copied: int
+    replayed_version: int
+
+
+def _replay_changes(
+    conn: Connection,
+    source: Table,
+    shadow: Table,
+    after_version: int,
+    until: Optional[datetime] = None,
+) -> tuple[int, int]:
+    """
+    Copy the rows of source that were written after version after_version again, up to
+    and including the time until, replacing the copied rows. Returns the last version
+    and the number of rows copied. Changes after until are skipped, as those rows are
+    copied later.
+    """
+    query = (
+        select(changes.c.version, changes.c.first_time, changes.c.last_time)
+        .where(changes.c.table_name == source.name, changes.c.version > after_version)
+        .order_by(changes.c.version)
+    )
+    logged = conn.execute(query).all()
+    if not logged:
+        return after_version, 0
+
+    # Merge the overlapping ranges, so that each row is only copied once
+    ranges: list[list[datetime]] = []
+    for _, first, last in sorted(logged, key=lambda change: change.first_time):
+        if ranges and first <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], last)
+        else:
+            ranges.append([first, last])
+    copied = 0
+    for first, last in ranges:
+        if until is not None:
+            if first > until:
+                break
+            last = min(last, until)
+        # Timestamps have microsecond resolution, so this includes the reading at first
+        copied += _copy_rows(
+            conn, source, shadow, first - timedelta(microseconds=1), last, overwrite=True
+        )
+    return logged[-1].version, copied
+
+
+def _start_migration(
+    fridge_table: type["SensorReading"],
+    source_name: str,
+    hypertable: bool,
+    restart: bool,
+) -> Optional[_Progress]:
+    """
+    Create the new table, or resume a previous migration into it. Returns the progress
+    of the migration, or None if it has already finished.
+    """
+    table_name = fridge_table.__table__.name
+    shadow_name = f"{table_name}{SHADOW_SUFFIX}"
+    migrations.create(db.engine, checkfirst=True)
+
+    with db.engine.begin() as conn:
+        if restart:
+            conn.execute(delete(migrations).where(migrations.c.table_name == table_name))
+        checkpoint = conn.execute(
+            select(migrations).where(migrations.c.table_name == table_name)
+        ).one_or_none()
+    if checkpoint is not None and checkpoint.finished is not None:
+        logger.info("%s was already migrated at %s", table_name, checkpoint.finished)
+        return None
+    if checkpoint is not None and inspect(db.engine).has_table(shadow_name):
+        logger.info("Resuming migration of %s from %s", table_name, checkpoint.copied_until)
+        return _Progress(
+            checkpoint.copied_until, checkpoint.rows_copied, checkpoint.replayed_version
+        )
+
+    logger.info("Creating %s", shadow_name)
+    _create_shadow(fridge_table, shadow_name, hypertable)
+    with db.engine.begin() as conn:
+        # Changes up to now are copied with the rest of the table
+        replayed_version = conn.execute(
+            select(func.coalesce(func.max(table_versions.c.version), 0)).where(
+                table_versions.c.table_name == source_name
+            )
+        ).scalar_one()
+        conn.execute(delete(migrations).where(migrations.c.table_name == table_name))
+        conn.execute(
+            migrations.insert().values(
+                table_name=table_name,
+                source=source_name,
+                rows_copied=0,
+                replayed_version=replayed_version,
+                started=datetime.now().astimezone(),
+            )
+        )
+    return _Progress(None, 0, replayed_version)
+
+
+def _copy_chunks(
+    table_name: str,
+    source: Table,
+    shadow: Table,
+    progress: _Progress,
+    chunk_rows: int,
+    pause: float,
+):
+    """
+    Copy the source table in chunks of chunk_rows rows, along with any changes to the rows
+    already copied, until less than a chunk of new uploads remains. progress is updated
+    as each chunk is copied.
+    """
+    time = source.c.time if "time" in source.c else source.c.Time
+    with db.engine.connect() as conn:
+        first, last = conn.execute(select(func.min(time), func.max(time))).one()
+
+    started, resumed_from = monotonic(), progress.rows_copied
+    while True:
+        with db.engine.begin() as conn:
+            query = select(time).order_by(time).offset(chunk_rows - 1).limit(1)
+            if progress.copied_until is not None:
+                query = query.where(time > progress.copied_until)
+            until = conn.execute(query).scalar_one_or_none()
+            if until is None:
+                # Less than a full chunk remains
+                return
+            copied = _copy_rows(conn, source, shadow, progress.copied_until, until)
+            # Copy any rows written since they were copied
+            replayed_version, replayed = _replay_changes(
+                conn, source, shadow, progress.replayed_version, until
+            )
+            conn.execute(
+                update(migrations)
+                .where(migrations.c.table_name == table_name)
+                .values(
+                    copied_until=until,
+                    rows_copied=migrations.c.rows_copied + copied,
+                    replayed_version=replayed_version,
+                )
+            )
+        progress.copied_until = until
+        progress.rows_copied += copied
+        progress.replayed_version = replayed_version
+        if replayed:
+            logger.info("%s: copied %d changed rows again", table_name, replayed)
+
+        if first is not None and last is not None and last > first:
+            fraction = min(1.0, (until - first) / (last - first))
+        else:
+            fraction = 1.0
+        logger.info(
+            "%s: copied %d rows up to %s (%.1f%%, %.0f rows/s)",
+            table_name,
+            progress.rows_copied,
+            until.isoformat(),
+            fraction * 100,
+            (progress.rows_copied - resumed_from) / max(monotonic() - started, 1e-3),
+        )
+        if pause:
+            sleep(pause)
+
+
+def _swap_tables(table_name: str, source: Table, shadow: Table, progress: _Progress):
+    """
+    Copy the remaining rows and changes while uploads are blocked, then rename the new
+    table into place. Reads of the source table can continue until it is renamed.
+    """
+    logger.info("Finishing migration of %s", table_name)
+    with db.engine.begin() as conn:
+        conn.execute(text(f'LOCK TABLE "{source.name}" IN EXCLUSIVE MODE'))
+        copied = _copy_rows(conn, source, shadow, progress.copied_until)
+        progress.replayed_version, replayed = _replay_changes(
+            conn, source, shadow, progress.replayed_version
+        )
+        logger.info("%s: copied %d new rows and %d changed rows", table_name, copied, replayed)
+        conn.execute(
+            text(f'ALTER TABLE IF EXISTS "{table_name}" RENAME TO "{table_name}{OLD_SUFFIX}"')
+        )
+        conn.execute(text(f'ALTER TABLE "{shadow.name}" RENAME TO "{table_name}"'))
+        conn.execute(
+            update(migrations)
+            .where(migrations.c.table_name == table_name)
+            .values(
+                rows_copied=migrations.c.rows_copied + copied,
+                replayed_version=progress.replayed_version,
+                finished=datetime.now().astimezone(),
+            )
+        )
+    progress.rows_copied += copied
+
+
+def _move_rollups_and_policies(
+    fridge_table: type["SensorReading"],
+    had_rollups: bool,
+    compress_after: Optional[str],
+    retain_raw: Optional[str],
+):
+    """
+    Move the storage policies from the previous table to the new one, and recreate the
+    rollups on the new table. Rollups are attached to a table rather than its name, so the
+    previous rollups are kept with the previous table.
+    """
+    table_name = fridge_table.__table__.name
+    old_name = f"{table_name}{OLD_SUFFIX}"
+    if had_rollups:
+        rename_rollups(fridge_table, OLD_SUFFIX)
+    if is_hypertable(old_name):
+        apply_storage_policies(old_name)
+    if not is_hypertable(table_name):
+        if had_rollups or compress_after is not None or retain_raw is not None:
+            logger.warning(
+                "%s is not a hypertable, so its rollups and storage policies were not recreated",
+                table_name,
+            )
+        return
+    # Apply the retention policy first, so that the rollups are only filled from the
+    # raw data that is kept
+    apply_storage_policies(table_name, compress_after, retain_raw)
+    if had_rollups:
+        create_rollups(fridge_table)
+        if retain_raw is not None:
+            logger.warning(
+                "Averages of %s older than %s are kept in the rollups of %s",
+                table_name,
+                retain_raw,
+                old_name,
+            )
+
+
+def migrate_table(
+    fridge_table: type["SensorReading"],
+    source_name: Optional[str] = None,
+    chunk_rows: int = 100_000,
+    pause: float = 0.0,
+    hypertable: bool = True,
+    restart: bool = False,
+    compress_after: Optional[str] = None,
+    retain_raw: Optional[str] = None,
+):
+    """
+    Copy a fridge table, or the table source_name, into a new table with the schema of
+    the fridge table, then replace the fridge table with the copy. Rows are copied
+    chunk_rows at a time, pausing for pause seconds between chunks. If restart is set,
+    any previous progress is discarded. The storage policies given by compress_after and
+    retain_raw are applied to the new table.
+    """
+    table_name = fridge_table.__table__.name
+    source_name = source_name or table_name
+    progress = _start_migration(fridge_table, source_name, hypertable, restart)
+    if progress is None:
+        return
+
+    metadata = MetaData()
+    source = Table(source_name, metadata, autoload_with=db.engine)
+    shadow = Table(f"{table_name}{SHADOW_SUFFIX}", metadata, autoload_with=db.engine)
+    _copy_chunks(table_name, source, shadow, progress, chunk_rows, pause)
+
+    inspector = inspect(db.engine)
+    had_rollups = any(
+        inspector.has_table(rollup_name(table_name, period)) for period in ROLLUP_PERIODS
+    )
+    _swap_tables(table_name, source, shadow, progress)
+    _move_rollups_and_policies(fridge_table, had_rollups, compress_after, retain_raw)
+    logger.info(
+        "Migrated %s (%d rows). The previous table was renamed to %s%s.",
+        table_name,
+        progress.rows_copied,
+        table_name,
+        OLD_SUFFIX,
+    )
@@ -0,0 +1,268 @@
+"""
+Precomputed hourly and daily averages of the fridge tables, maintained by TimescaleDB as
+continuous aggregates. Averages over these periods (and over months, from the daily
+rollup) are read from the rollups where they exist, rather than scanning the raw data.
+
+Each rollup stores the average and count of each sensor in each bucket, so that the
+rollups can be combined into averages over longer periods.
+"""
+
+import logging
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from typing import TYPE_CHECKING, Optional
+
+from flask import current_app
+from sqlalchemy import (
+    ColumnElement,
+    Connection,
+    Float,
+    MetaData,
+    Table,
+    cast,
+    func,
+    inspect,
+    text,
+)
+
+from .db import db
+
+if TYPE_CHECKING:
+    from .fridge_table import SensorReading
+
+logger = logging.getLogger(__name__)
+
+# Rollups that are maintained, and the bucket width of each
+ROLLUP_PERIODS = {"hour": "1 hour", "day": "1 day"}
+ROLLUP_SUFFIXES = {"hour": "hourly", "day": "daily"}
+# The rollup that can be used to calculate the average over each period
+ROLLUP_SOURCES = {"hour": "hour", "day": "day", "month": "day"}
+COUNT_SUFFIX = "__count"
+# Continuous aggregates are refreshed by timescale in the background, covering data
+# from REFRESH_START ago until REFRESH_END ago. More recent data is aggregated when
+# queried. Older writes must be refreshed with refresh_rollups.
+REFRESH_START = timedelta(days=3)
+REFRESH_END = timedelta(hours=1)
+REFRESH_SCHEDULE = timedelta(minutes=30)
+# Longest bucket of each rollup, as days are longer across daylight saving changes
+ROLLUP_WIDTHS = {"hour": timedelta(hours=1), "day": timedelta(hours=25)}
+
+# Cache of rollups by (table name, period), along with the time at which we checked
+# whether the rollup exists
+_rollups: dict[tuple[str, str], tuple[float, Optional["Rollup"]]] = {}
+_rollup_metadata = MetaData()
+_rollup_lock = Lock()
+
+
+@dataclass(frozen=True)
+class Rollup:
+    period: str
+    table: Table
+
+    @property
+    def sensors(self) -> set[str]:
+        """
+        The sensors that are averaged by the rollup. Sensors added to the fridge table
+        after the rollup was created are missing until the rollup is recreated.
+        """
+        return {
+            column.name
+            for column in self.table.columns
+            if f"{column.name}{COUNT_SUFFIX}" in self.table.c
+        }
+
+    def averages(
+        self, time_period: str, columns: list[str]
+    ) -> tuple[ColumnElement, list[ColumnElement], bool]:
+        """
+        Return the time bucket and averaged columns over the given time period, and
+        whether the rollup must be grouped by the time bucket to get these averages.
+        """
+        if time_period == self.period:
+            averages = [self.table.c[name].label(name) for name in columns]
+            return self.table.c.time, averages, False
+
+        # Otherwise combine the averages of each bucket, weighted by the number of readings
+        dategroup = func.date_trunc(time_period, self.table.c.time)
+        averages = []
+        for name in columns:
+            value = self.table.c[name]
+            count = cast(self.table.c[f"{name}{COUNT_SUFFIX}"], Float)
+            total = func.sum(value * count) / func.nullif(func.sum(count), 0)
+            averages.append(total.label(name))
+        return dategroup, averages, True
+
+
+def rollup_name(table_name: str, period: str) -> str:
+    return f"{table_name}_{ROLLUP_SUFFIXES[period]}"
+
+
+def _sensor_columns(fridge_table: type["SensorReading"]) -> list[str]:
+    return [field.name for field in fields(fridge_table) if field.name != "time"]
+
+
+def get_rollup(fridge_table: type["SensorReading"], time_period: str) -> Optional[Rollup]:
+    """
+    Return the rollup that can be used to calculate averages of a fridge table over
+    the given time period, or None if there isn't one.
+    """
+    if time_period not in ROLLUP_SOURCES:
+        return None
+    period = ROLLUP_SOURCES[time_period]
+    name = rollup_name(fridge_table.__table__.name, period)
+
+    # Check whether the rollup exists, caching the result for the same time as other metadata
+    key = (fridge_table.__table__.name, period)
+    ttl = current_app.config.get("METADATA_CACHE_TTL", 0)
+    cached = _rollups.get(key)
+    if cached is not None and monotonic() - cached[0] < ttl:
+        return cached[1]
+
+    rollup = None
+    # Reflecting into the shared metadata isn't thread safe
+    with _rollup_lock:
+        if inspect(db.engine).has_table(name):
+            # Read the columns the rollup actually has, which may have changed since we
+            # last checked if the rollup was recreated
+            if name in _rollup_metadata.tables:
+                _rollup_metadata.remove(_rollup_metadata.tables[name])
+            table = Table(name, _rollup_metadata, autoload_with=db.engine)
+            rollup = Rollup(period, table)
+        _rollups[key] = (monotonic(), rollup)
+    return rollup
+
+
+def create_rollups(fridge_table: type["SensorReading"], refresh: bool = True):
+    """
+    Create the rollups of a fridge table as continuous aggregates, along with the
+    policies that keep them up to date. If refresh is set, the rollups are also
+    filled with the existing data, which may take a long time for large tables. Buckets
+    older than the raw data kept by the retention policy are left as they are, so
+    existing averages of dropped data are kept.
+    Requires TimescaleDB, and the fridge table must be a hypertable.
+    """
+    table_name = fridge_table.__table__.name
+    # Continuous aggregates can't be created inside a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Buckets should line up with date_trunc, which uses the server timezone
+        timezone = conn.execute(text("SHOW TimeZone")).scalar_one()
+        for period, interval in ROLLUP_PERIODS.items():
+            name = rollup_name(table_name, period)
+            aggregates = []
+            for column in _sensor_columns(fridge_table):
+                aggregates.append(f'avg("{column}") AS "{column}"')
+                aggregates.append(f'count("{column}") AS "{column}{COUNT_SUFFIX}"')
+            logger.info("Creating rollup %s", name)
+            conn.execute(
+                text(
+                    f'CREATE MATERIALIZED VIEW IF NOT EXISTS "{name}" '
+                    "WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS "
+                    f"SELECT time_bucket(INTERVAL '{interval}', time, '{timezone}') AS time, "
+                    f"{', '.join(aggregates)} "
+                    f'FROM "{table_name}" GROUP BY 1 WITH NO DATA'
+                )
+            )
+            conn.execute(
+                text(
+                    "SELECT add_continuous_aggregate_policy(CAST(:name AS REGCLASS), "
+                    "start_offset => CAST(:start AS INTERVAL), "
+                    "end_offset => CAST(:end AS INTERVAL), "
+                    "schedule_interval => CAST(:schedule AS INTERVAL), "
+                    "if_not_exists => true)"
+                ),
+                {
+                    "name": f'"{name}"',
+                    "start": REFRESH_START,
+                    "end": REFRESH_END,
+                    "schedule": REFRESH_SCHEDULE,
+                },
+            )
+            if refresh:
+                logger.info("Filling rollup %s with existing data", name)
+                _refresh_rollup(conn, name, _raw_data_start(conn, table_name))
+
+
+def refresh_rollups(fridge_table: type["SensorReading"], start: datetime, stop: datetime):
+    """
+    Recompute the buckets of the rollups of a fridge table that contain readings between
+    start and stop. Timescale only refreshes the last REFRESH_START of data in the
+    background, so this must be called after writing older readings.
+    """
+    table_name = fridge_table.__table__.name
+    rollups = [rollup for period in ROLLUP_PERIODS if (rollup := get_rollup(fridge_table, period))]
+    if not rollups:
+        return
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        raw_start = _raw_data_start(conn, table_name)
+        for rollup in rollups:
+            # Only whole buckets within the window are refreshed
+            width = ROLLUP_WIDTHS[rollup.period]
+            window_start = start - width
+            if raw_start is not None and window_start < raw_start:
+                window_start = raw_start
+            logger.info("Refreshing rollup %s from %s to %s", rollup.table.name, start, stop)
+            _refresh_rollup(conn, rollup.table.name, window_start, stop + width)
+
+
+def _raw_data_start(conn: Connection, table_name: str) -> Optional[datetime]:
+    """
+    Return the time from which raw readings are kept by the retention policy of a fridge
+    table, or None if it has no retention policy
+    """
+    return conn.execute(
+        text(
+            "SELECT now() - CAST(config->>'drop_after' AS INTERVAL) "
+            "FROM timescaledb_information.jobs "
+            "WHERE proc_name = 'policy_retention' AND hypertable_name = :name"
+        ),
+        {"name": table_name},
+    ).scalar_one_or_none()
+
+
+def _refresh_rollup(
+    conn: Connection, name: str, start: Optional[datetime] = None, stop: Optional[datetime] = None
+):
+    """
+    Recompute the buckets of a rollup that lie entirely between start and stop, which
+    default to the start and end of the data. Buckets whose raw data has been dropped are
+    emptied by a refresh, so start must not be before the start of the raw data.
+    """
+    window = ", ".join(
+        "NULL" if bound is None else f"CAST('{bound.isoformat()}' AS TIMESTAMPTZ)"
+        for bound in (start, stop)
+    )
+    conn.execute(text(f"CALL refresh_continuous_aggregate('{name}', {window})"))
+
+
+def drop_rollups(fridge_table: type["SensorReading"]):
+    """
+    Remove the rollups of a fridge table. Averages of raw data that has been dropped by
+    the retention policy are lost, and can't be recreated.
+    """
+    table_name = fridge_table.__table__.name
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for period in ROLLUP_PERIODS:
+            name = rollup_name(table_name, period)
+            logger.info("Dropping rollup %s", name)
+            conn.execute(text(f'DROP MATERIALIZED VIEW IF EXISTS "{name}"'))
+    with _rollup_lock:
+        _rollups.clear()
+
+
+def rename_rollups(fridge_table: type["SensorReading"], suffix: str):
+    """
+    Add a suffix to the names of the rollups of a fridge table, keeping their data.
+    The rollups remain attached to the table they were created on.
+    """
+    table_name = fridge_table.__table__.name
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for period in ROLLUP_PERIODS:
+            name = rollup_name(table_name, period)
+            logger.info("Renaming rollup %s to %s%s", name, name, suffix)
+            conn.execute(
+                text(f'ALTER MATERIALIZED VIEW IF EXISTS "{name}" RENAME TO "{name}{suffix}"')
+            )
+    with _rollup_lock:
+        _rollups.clear()
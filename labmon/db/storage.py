@@ -0,0 +1,166 @@
+"""
+Compression and retention policies of the fridge tables, which are TimescaleDB hypertables.
+Chunks are compressed (ordered by time) once they are older than the compress_after
+interval of the fridge, and raw readings older than retain_raw are dropped. The hourly
+and daily rollups are not affected by retention, and are only ever refreshed over the raw
+data that is kept, so averages of dropped data remain available unless the rollups are
+dropped.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from .db import db
+from .rollups import REFRESH_START
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StorageStats:
+    table_name: str
+    total_bytes: int
+    total_chunks: int
+    compressed_chunks: int
+    # Size of the compressed chunks before and after compression
+    before_compression_bytes: int
+    after_compression_bytes: int
+
+    @property
+    def compression_ratio(self) -> Optional[float]:
+        if not self.after_compression_bytes:
+            return None
+        return self.before_compression_bytes / self.after_compression_bytes
+
+
+def is_hypertable(table_name: str) -> bool:
+    """
+    Check whether a table is a TimescaleDB hypertable, returning False if TimescaleDB
+    isn't installed
+    """
+    with db.engine.connect() as conn:
+        installed = conn.execute(
+            text("SELECT to_regclass('timescaledb_information.hypertables') IS NOT NULL")
+        ).scalar_one()
+        if not installed:
+            return False
+        return conn.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM timescaledb_information.hypertables "
+                "WHERE hypertable_name = :name)"
+            ),
+            {"name": table_name},
+        ).scalar_one()
+
+
+def check_storage_policies(
+    table_name: str, compress_after: Optional[str] = None, retain_raw: Optional[str] = None
+):
+    """
+    Check that the storage policies of a fridge table are valid intervals, raising
+    ValueError otherwise. This makes no changes, so should be called before storing or
+    applying new policies.
+    """
+    with db.engine.connect() as conn:
+        for name, interval in (("compress_after", compress_after), ("retain_raw", retain_raw)):
+            if interval is None:
+                continue
+            try:
+                conn.execute(text("SELECT CAST(:interval AS INTERVAL)"), {"interval": interval})
+            except DBAPIError as e:
+                raise ValueError(f"Invalid {name} for {table_name}: {interval!r}") from e
+        if retain_raw is not None:
+            # The rollups are refreshed from the raw data, so it must be kept for longer
+            # than the refresh window
+            valid = conn.execute(
+                text("SELECT CAST(:retain AS INTERVAL) > CAST(:refresh AS INTERVAL)"),
+                {"retain": retain_raw, "refresh": REFRESH_START},
+            ).scalar_one()
+            if not valid:
+                raise ValueError(
+                    f"Raw data for {table_name} must be retained for longer than {REFRESH_START}"
+                )
+
+
+def apply_storage_policies(
+    table_name: str, compress_after: Optional[str] = None, retain_raw: Optional[str] = None
+):
+    """
+    Set the compression and retention policies of a fridge table, removing any policy
+    that is None. Requires TimescaleDB, and the fridge table must be a hypertable.
+    Raises ValueError, without changing the existing policies, if the policies are invalid.
+    """
+    check_storage_policies(table_name, compress_after, retain_raw)
+    hypertable = f'"{table_name}"'
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Remove the existing policies, which may have a different interval
+        conn.execute(
+            text("SELECT remove_compression_policy(CAST(:t AS REGCLASS), if_exists => true)"),
+            {"t": hypertable},
+        )
+        conn.execute(
+            text("SELECT remove_retention_policy(CAST(:t AS REGCLASS), if_exists => true)"),
+            {"t": hypertable},
+        )
+
+        if compress_after is not None:
+            enabled = conn.execute(
+                text(
+                    "SELECT compression_enabled FROM timescaledb_information.hypertables "
+                    "WHERE hypertable_name = :name"
+                ),
+                {"name": table_name},
+            ).scalar_one()
+            if not enabled:
+                # Every sensor is stored in each row, so there is no column to segment by
+                logger.info("Enabling compression on %s", table_name)
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {hypertable} SET (timescaledb.compress, "
+                        "timescaledb.compress_orderby = 'time DESC', "
+                        "timescaledb.compress_segmentby = '')"
+                    )
+                )
+            logger.info("Compressing %s after %s", table_name, compress_after)
+            conn.execute(
+                text(
+                    "SELECT add_compression_policy(CAST(:t AS REGCLASS), "
+                    "compress_after => CAST(:after AS INTERVAL))"
+                ),
+                {"t": hypertable, "after": compress_after},
+            )
+
+        if retain_raw is not None:
+            logger.info("Dropping raw data from %s after %s", table_name, retain_raw)
+            conn.execute(
+                text(
+                    "SELECT add_retention_policy(CAST(:t AS REGCLASS), "
+                    "drop_after => CAST(:retain AS INTERVAL))"
+                ),
+                {"t": hypertable, "retain": retain_raw},
+            )
+
+
+def get_storage_stats(table_name: str) -> StorageStats:
+    """
+    Return the size of a fridge table, and how well its chunks are compressed. The
+    fridge table must be a hypertable.
+    """
+    hypertable = f'"{table_name}"'
+    total_bytes = db.session.execute(
+        text("SELECT hypertable_size(CAST(:t AS REGCLASS))"), {"t": hypertable}
+    ).scalar_one()
+    compression = db.session.execute(
+        text(
+            "SELECT total_chunks, number_compressed_chunks, before_compression_total_bytes, "
+            "after_compression_total_bytes FROM hypertable_compression_stats(CAST(:t AS REGCLASS))"
+        ),
+        {"t": hypertable},
+    ).one_or_none()
+    if compression is None:
+        return StorageStats(table_name, total_bytes or 0, 0, 0, 0, 0)
+    return StorageStats(table_name, total_bytes or 0, *(value or 0 for value in compression))
@@ -0,0 +1,128 @@
+"""
+Export the data of a fridge for download as CSV or Parquet
+"""
+
+import io
+from datetime import datetime
+from typing import Iterator, Optional
+
+from flask import Response, request, stream_with_context
+from flask.views import MethodView
+
+from .db import get_fridge_metadata
+from .db.fridge_table import SensorReading
+from .query import parse_columns, parse_request_time
+
+# Formats that data can be exported in, and their mimetypes
+EXPORT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+# Number of rows in each row group of an exported Parquet file
+EXPORT_BATCH_SIZE = 100_000
+
+
+class _ChunkWriter(io.RawIOBase):
+    """
+    Write-only file that collects the bytes written to it, so that they can be
+    streamed to the client as they are produced
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._position
+
+    def pop(self) -> bytes:
+        """
+        Return and clear the bytes written since the last call to pop
+        """
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ExportView(MethodView):
+    """
+    Export the data of a fridge for download, as CSV or Parquet. Exports can cover
+    any range of time, so are streamed to the client rather than built in memory.
+    """
+
+    def _parquet_stream(
+        self,
+        fridge_table: type[SensorReading],
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Iterator[bytes]:
+        """
+        Write the data as a Parquet file, with a row group for each batch of rows read
+        from the database, and yield each row group as it is written.
+        """
+        # pylint: disable=import-outside-toplevel
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        names = fridge_table.sensor_names() if columns is None else columns
+        schema = pa.schema(
+            [("time", pa.timestamp("us", tz="UTC"))] + [(name, pa.float64()) for name in names]
+        )
+        sink = _ChunkWriter()
+        with pq.ParquetWriter(sink, schema) as writer:
+            batches = fridge_table.export_columns(start, stop, columns, EXPORT_BATCH_SIZE)
+            for times, data in batches:
+                arrays = [pa.array(times, type=schema.field("time").type)]
+                arrays.extend(pa.array(data[name], type=pa.float64()) for name in names)
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                yield sink.pop()
+        yield sink.pop()
+
+    def get(self, fridge_name, supp) -> Response:
+        try:
+            data_source = get_fridge_metadata(fridge_name, supp)
+        except KeyError:
+            return Response(f"Unable to find fridge {fridge_name}, supp: {supp}.", status=404)
+        fridge_table = data_source.fridge_table()
+
+        export_format = request.args.get("format", "csv")
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                (
+                    f"Data can only be exported as {', '.join(EXPORT_FORMATS)}. "
+                    f"Requested {export_format}."
+                ),
+                status=400,
+            )
+        try:
+            start = parse_request_time(request.args["start"]) if "start" in request.args else None
+            stop = parse_request_time(request.args["stop"]) if "stop" in request.args else None
+        except ValueError:
+            return Response("Invalid start or stop date.", status=400)
+        try:
+            columns = parse_columns(data_source)
+        except KeyError as e:
+            return Response(f"Unknown columns: {e.args[0]}", status=400)
+
+        if export_format == "parquet":
+            try:
+                # pylint: disable=import-outside-toplevel,unused-import
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                return Response("Parquet export requires pyarrow to be installed.", status=501)
+            stream = self._parquet_stream(fridge_table, start, stop, columns)
+        else:
+            stream = fridge_table.export_csv(start, stop, columns)
+
+        r = Response(stream_with_context(stream), mimetype=EXPORT_FORMATS[export_format])
+        filename = f"{data_source.table_name}.{export_format}"
+        r.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        return r
@@ -1,17 +1,63 @@
-from dataclasses import asdict, fields
+import json
+from array import array
+from dataclasses import asdict, replace
 from datetime import datetime, timedelta
+from hashlib import sha1
 from math import isinf, isnan
-from typing import Iterable, Optional, TypeVar
+from queue import Empty
+from time import monotonic
+from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence, TypeVar
+from urllib.parse import urlencode
 
-from flask import Blueprint, Response, g, request
+from flask import Blueprint, Response, current_app, g, request, stream_with_context
 from flask.json import jsonify
 from flask.views import MethodView
 
-from .db import Fridge, FridgeSupplementary
-from .db.abc import FridgeModel, SensorReading
+from .cache import CachedResponse, get_response_cache
+from .db import FridgeMetadata, db, get_fleet_metadata, get_fridge_metadata
+from .db.changes import CHANGE_LOG_RETENTION, changed_between, earliest_change, get_version
+from .db.fridge_table import (
+    BUCKET_WIDTHS,
+    CONFLICT_MODES,
+    MAX_PERIOD_LENGTHS,
+    STATISTICS,
+    Columns,
+    SensorReading,
+    choose_period,
+    get_last_many,
+    live_channel,
+)
+from .export import ExportView
+from .live import TooManySubscribers, get_listener
+from .query import DataOptions, parse_data_options, parse_date_range, parse_request_time
+from .write_buffer import QueueFull, WriteTimeout, get_write_buffer
+from .utility.columnar import COLUMNAR_MIMETYPE, pack_columns
+from .utility.downsample import downsample
+from .utility.fastjson import dumps_columns
 
 fridge_bp = Blueprint("fridge_data", __name__)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+# Number of rows fetched from the database and written out at a time when streaming
+STREAM_BATCH_SIZE = 1000
+# Interval between keepalive messages on the live stream, in seconds
+LIVE_KEEPALIVE_INTERVAL = 15.0
+# Number of buckets to aim for when choosing an averaging period automatically
+AUTO_PERIOD_POINTS = 1000
+# Most raw readings that are downsampled in Python. Longer ranges are averaged in the
+# database first.
+MAX_DOWNSAMPLE_ROWS = 200_000
+# Data responses depend on the requested format, and cached responses are gzip encoded
+DATA_VARY = "Accept, Accept-Encoding"
+# Appended to the ETag of gzip encoded responses, which differ from the identity encoding
+GZIP_ETAG_SUFFIX = "-gzip"
+# Longest interval of raw readings that can be requested in a single response
+MAX_RAW_INTERVAL = timedelta(days=30)
+# Maximum number of readings returned in each page of a paginated request
+MAX_PAGE_LIMIT = 50_000
+# Percentiles returned by the statistics view by default
+DEFAULT_PERCENTILES = (5.0, 50.0, 95.0)
+
 
 T = TypeVar("T")
 
@@ -20,21 +66,29 @@ def _first(iterable: Iterable[T]) -> T:
     return next(iter(iterable))
 
 
+def _parse_upload_time(value: str | float) -> datetime:
+    """
+    Convert an uploaded time, given either as an ISO formatted string or a
+    timestamp, into a datetime. Raises ValueError if the time is invalid.
+    """
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(float(value))
+
+
 class FridgeView(MethodView):
-    def _get_data_source(self, fridge_name: str, supp: Optional[str]) -> Optional[FridgeModel]:
+    def _get_data_source(self, fridge_name: str, supp: Optional[str]) -> Optional[FridgeMetadata]:
         try:
-            g.fridge = Fridge.get_fridge_by_name(fridge_name)
-            if supp is not None:
-                g.fridge_supp = FridgeSupplementary.get_fridge_supp_by_name(g.fridge, supp)
-                g.fridge_table = g.fridge_supp.fridge_table()
-                return g.fridge_supp
-            g.fridge_supp = None
-            g.fridge_table = g.fridge.fridge_table()
-            return g.fridge
+            g.data_source = get_fridge_metadata(fridge_name, supp)
+            g.fridge_table = g.data_source.fridge_table()
+            return g.data_source
         except KeyError:
             return None
 
-    def _sensors_view(self, data_source: FridgeModel) -> Response:
+    def _sensors_view(self, data_source: FridgeMetadata) -> Response:
         """
         Return a list of sensors and their friendly label
         """
@@ -55,12 +109,14 @@ class FridgeView(MethodView):
         r.headers["Cache-Control"] = "public, max-age=300"
         return r
 
-    def _current_view(self, data_source: FridgeModel) -> Response:
+    def _current_view(
+        self, data_source: FridgeMetadata, columns: Optional[list[str]] = None
+    ) -> Response:
         """
         Return the current data from the fridge
         """
-        latest_data = _first(data_source.fridge_table().get_last(1))
-        data = asdict(latest_data)
+        latest_data = _first(data_source.fridge_table().get_last(1, columns))
+        data = asdict(latest_data) if columns is None else latest_data._asdict()
         data["time"] = data["time"].isoformat()
         for k in data:
             if isinstance(data[k], float) and (isinf(data[k]) or isnan(data[k])):
@@ -72,35 +128,58 @@ class FridgeView(MethodView):
         r.headers["Cache-Control"] = "public, max-age=5"
         return r
 
-    def _summary_view(self, data_source: FridgeModel) -> Response:
+    def _live_view(self, data_source: FridgeMetadata) -> Response:
+        """
+        Stream each new reading to the client as a server-sent event
+        """
+        if not current_app.config.get("LIVE_UPDATES", False):
+            return Response("Live updates are not enabled on this server.", status=501)
+        url = db.engine.url.set(drivername="postgresql")
+        listener = get_listener(url.render_as_string(hide_password=False))
+        channel = live_channel(data_source.table_name)
+
+        # Each stream holds a worker thread for as long as it is open, so limit the number
+        # of streams to leave threads free for other requests
+        try:
+            queue = listener.subscribe(channel, current_app.config.get("LIVE_MAX_STREAMS", 16))
+        except TooManySubscribers as e:
+            r = Response(f"Unable to open live stream. {e}.", status=503)
+            r.headers["Retry-After"] = str(int(LIVE_KEEPALIVE_INTERVAL))
+            return r
+
+        def stream() -> Iterator[str]:
+            while True:
+                try:
+                    yield f"data: {queue.get(timeout=LIVE_KEEPALIVE_INTERVAL)}\n\n"
+                except Empty:
+                    # Keep the connection open, and check that the client is still there
+                    yield ": keepalive\n\n"
+
+        r = Response(stream(), mimetype="text/event-stream")
+        # Unsubscribe once the stream is closed, even if it never started
+        r.call_on_close(lambda: listener.unsubscribe(channel, queue))
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        r.headers["Cache-Control"] = "no-cache"
+        # Disable buffering if we are behind nginx
+        r.headers["X-Accel-Buffering"] = "no"
+        return r
+
+    def _summary_view(
+        self,
+        data_source: FridgeMetadata,
+        avg_period: Optional[str] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Response:
         """
         Try to return a useful summary of the most useful thermometer associated with
         a data source. By default, we return the last 2 hours of data.
+        For most situations, the coldest thermometer is usually the right one to return,
+        so we return the minimum valid value of each reading, optionally averaged over
+        the given period.
         """
-        sensors = data_source.sensors
         stop = datetime.now().astimezone()
         start = stop - timedelta(hours=2)
-        latest_data = data_source.fridge_table().get_between(start, stop)
-
-        # For most situations, the coldest thermometer is usually the right one to return
-        # Let's preprocess out the minimum value from the sensor.
-        summary_data: list[Optional[float]] = []
-        for data in latest_data:
-            min_val = float("inf")
-            for sensor in sensors:
-                # Time is not sensor data
-                if sensor.column_name == "time":
-                    continue
-                val = getattr(data, sensor.column_name)
-                # Ignore NaN or inf values
-                if val is None or isnan(val) or isinf(val) or val == 0:
-                    continue
-                min_val = min(min_val, val)
-            # If we didn't find any readings, add None
-            if isinf(min_val):
-                summary_data.append(None)
-            else:
-                summary_data.append(min_val)
+        summary_data = data_source.fridge_table().get_minimum(start, stop, avg_period, columns)
 
         # Construct response
         r = jsonify(summary_data)
@@ -108,172 +187,732 @@ class FridgeView(MethodView):
         r.headers["Cache-Control"] = "public, max-age=5"
         return r
 
-    def _format_data(
-        self, fridge_table: type[SensorReading], rows: Iterable[SensorReading]
-    ) -> dict[str, list]:
-        # Format the data correctly
-        data: dict[str, list[Optional[float]]] = {}
-        columns = []
-        for field in fields(fridge_table):
-            data[field.name] = []
-            if field.name != "time":
-                columns.append(field.name)
-        for row in rows:
-            data["time"].append(row.time.isoformat())
-            for field_name in columns:
-                field_data = getattr(row, field_name)
-                if field_data is not None and (isnan(field_data) or isinf(field_data)):
-                    field_data = None
-                data[field_name].append(field_data)
+    def _downsample(
+        self, columns: Columns, points: Optional[int] = None, method: str = "lttb"
+    ) -> Columns:
+        """
+        If points is given, downsample the sensors together to at most that many points
+        using the given method
+        """
+        times, data = columns
+        if points is not None and len(times) > points:
+            timestamps = [time.timestamp() for time in times]
+            keep = downsample(timestamps, list(data.values()), points, method)
+            times = [times[i] for i in keep]
+            data = {name: array("d", (values[i] for i in keep)) for name, values in data.items()}
+        return times, data
+
+    def _stream_data(
+        self,
+        fridge_table: type[SensorReading],
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Iterator[str]:
+        """
+        Format rows as newline delimited JSON, yielding a batch of rows at a time.
+        Note that the query must be run from within the generator, as the session
+        used by the view is closed once the view returns.
+        """
+        # Read plain rows rather than readings
+        if columns is None:
+            columns = fridge_table.sensor_names()
+        rows = fridge_table.get_between(start, stop, yield_per=STREAM_BATCH_SIZE, columns=columns)
+        lines = []
+        for time, *values in rows:
+            line: dict[str, Optional[float | str]] = {"time": time.isoformat()}
+            for field_name, val in zip(columns, values):
+                if val is not None and (isnan(val) or isinf(val)):
+                    val = None
+                line[field_name] = val
+            lines.append(json.dumps(line))
+            if len(lines) >= STREAM_BATCH_SIZE:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    def _response_format(self, *extra_formats: str) -> str:
+        """
+        Return the response format requested by the client. By default this is JSON,
+        but clients may also request the packed columnar format, or any of the extra
+        formats supported by the view.
+        """
+        offers = ["application/json", COLUMNAR_MIMETYPE, *extra_formats]
+        return request.accept_mimetypes.best_match(offers, default="application/json")
 
-        return data
+    def _data_response(self, columns: Columns) -> Response:
+        """
+        Construct a response in the format requested by the client. JSON responses give
+        times as ISO formatted strings, or as milliseconds since the epoch if the epoch
+        argument is given.
+        """
+        times, data = columns
+        if self._response_format() == COLUMNAR_MIMETYPE:
+            r = Response(pack_columns(times, data), mimetype=COLUMNAR_MIMETYPE)
+        else:
+            body = dumps_columns(times, data, epoch="epoch" in request.args)
+            r = Response(body, mimetype="application/json")
+        r.headers["Vary"] = "Accept"
+        return r
+
+    def _stats_view(
+        self,
+        data_source: FridgeMetadata,
+        start: datetime,
+        stop: datetime,
+        options: DataOptions,
+        percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+    ) -> Response:
+        """
+        Return statistics of each sensor between the start and stop dates, optionally
+        for each bucket of the given averaging period. For each sensor, we return the
+        STATISTICS and the requested percentiles, keyed as e.g. "p50". These are single
+        values, or lists of values for each bucket if an averaging period is given.
+        """
+        fridge_table = data_source.fridge_table()
+        names = fridge_table.sensor_names() if options.columns is None else options.columns
+        fractions = [percentile / 100 for percentile in percentiles]
+        rows = fridge_table.get_stats(start, stop, options.avg_period, options.columns, fractions)
+
+        stats: dict[str, Any] = {"start": start.isoformat(), "stop": stop.isoformat()}
+        if options.avg_period is not None:
+            stats["time"] = [row.time.isoformat() for row in rows]
+        for name in names:
+            sensor_stats: dict[str, list] = {stat: [] for stat in STATISTICS}
+            sensor_stats.update({f"p{percentile:g}": [] for percentile in percentiles})
+            for row in rows:
+                for stat in STATISTICS:
+                    sensor_stats[stat].append(getattr(row, f"{name}_{stat}"))
+                values = getattr(row, f"{name}_percentiles") or [None] * len(percentiles)
+                for percentile, value in zip(percentiles, values):
+                    sensor_stats[f"p{percentile:g}"].append(value)
+            if options.avg_period is None:
+                # Without buckets there is exactly one row of statistics
+                stats[name] = {stat: values[0] for stat, values in sensor_stats.items()}
+            else:
+                stats[name] = sensor_stats
+
+        # Construct response
+        r = jsonify(stats)
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        r.headers["Cache-Control"] = "public, max-age=30"
+        return r
+
+    def _get_averaged(
+        self,
+        fridge_table: type[SensorReading],
+        options: DataOptions,
+        start: Optional[datetime] = None,
+        stop: Optional[datetime] = None,
+        count: Optional[int] = None,
+    ) -> Columns:
+        """
+        Return the data averaged over the averaging period, or the requested aggregates
+        of the data
+        """
+        assert options.avg_period is not None
+        if options.aggregates is None:
+            return fridge_table.avg_data_columns(
+                options.avg_period, start, stop, count, options.columns
+            )
+        return fridge_table.aggregate_data_columns(
+            options.avg_period, options.aggregates, start, stop, count, options.columns
+        )
+
+    def _get_raw(
+        self,
+        fridge_table: type[SensorReading],
+        start: Optional[datetime],
+        stop: Optional[datetime],
+        points: Optional[int] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Columns:
+        """
+        Return the raw data between start and stop. If the data is to be downsampled and
+        there are more than MAX_DOWNSAMPLE_ROWS readings, they are first averaged in the
+        database over the shortest period that gives at most that many buckets.
+        """
+        if points is not None and start is not None and stop is not None:
+            count = fridge_table.count_between(start, stop, MAX_DOWNSAMPLE_ROWS + 1)
+            if count > MAX_DOWNSAMPLE_ROWS:
+                avg_period = choose_period(stop - start, MAX_DOWNSAMPLE_ROWS)
+                return fridge_table.avg_data_columns(avg_period, start, stop, columns=columns)
+        return fridge_table.get_between_columns(start, stop, columns)
 
     def _count_view(
-        self, data_source: FridgeModel, count: int = 1, avg_period: Optional[str] = None
+        self,
+        data_source: FridgeMetadata,
+        count: int,
+        options: DataOptions,
     ) -> Response:
         """
         Return the latest "n" fields from the data
         """
         fridge_table = data_source.fridge_table()
-        if avg_period is None:
-            latest_n_data = fridge_table.get_last(count)
+        if options.avg_period is None:
+            latest_n_data = fridge_table.get_last_columns(count, options.columns)
         else:
-            latest_n_data = fridge_table.avg_data(avg_period, count=count)
-        data = self._format_data(fridge_table, latest_n_data)
+            latest_n_data = self._get_averaged(fridge_table, options, count=count)
 
         # Construct response
-        r = jsonify(data)
+        r = self._data_response(latest_n_data)
         r.headers["Access-Control-Allow-Origin"] = "*"
         r.headers["Cache-Control"] = "public, max-age=30"
         return r
 
+    def _since_view(
+        self,
+        data_source: FridgeMetadata,
+        since: datetime,
+        since_version: Optional[int] = None,
+        count: Optional[int] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Response:
+        """
+        Return the data added since the given time, oldest first, up to "n" fields if a
+        count is given (and at most MAX_PAGE_LIMIT fields). The time of the last reading
+        returned and the version of the table are given in the X-Cursor header, which
+        can be passed as since in the next request to continue from there. If readings
+        at or before the cursor were written after that version, the data is returned
+        again from the earliest of them, so some readings may be sent more than once.
+        """
+        fridge_table = data_source.fridge_table()
+        if since_version is not None:
+            changed = earliest_change(data_source.table_name, since_version, since)
+            if changed is not None:
+                since = changed - timedelta(microseconds=1)
+        limit = MAX_PAGE_LIMIT if count is None else min(count, MAX_PAGE_LIMIT)
+        times, data = fridge_table.get_since_columns(since, limit, columns)
+
+        # Construct response
+        r = self._data_response((times, data))
+        cursor = (times[-1] if times else since).isoformat()
+        version = g.get("table_version")
+        r.headers["X-Cursor"] = cursor if version is None else f"{cursor}@{version}"
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        r.headers["Access-Control-Expose-Headers"] = "X-Cursor"
+        r.headers["Cache-Control"] = "public, max-age=5"
+        return r
+
+    def _page_view(
+        self,
+        data_source: FridgeMetadata,
+        start: datetime,
+        stop: datetime,
+        limit: int,
+        after: Optional[datetime] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Response:
+        """
+        Return a page of raw data between the start and stop dates. If the page is full,
+        the time of its last reading is returned in the X-Cursor header, and can be
+        passed as after to fetch the next page. The last page has no cursor.
+        """
+        fridge_table = data_source.fridge_table()
+        times, data = fridge_table.get_page_columns(start, stop, limit, after, columns)
+
+        # Construct response
+        r = self._data_response((times, data))
+        if len(times) == limit:
+            cursor = times[-1].isoformat()
+            next_args = request.args.copy()
+            next_args["after"] = cursor
+            r.headers["X-Cursor"] = cursor
+            r.headers["Link"] = (
+                f'<{request.base_url}?{urlencode(list(next_args.items(multi=True)))}>; rel="next"'
+            )
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        r.headers["Access-Control-Expose-Headers"] = "X-Cursor, Link"
+        r.headers["Cache-Control"] = "public, max-age=300"
+        return r
+
     def _date_view(
         self,
-        data_source: FridgeModel,
+        data_source: FridgeMetadata,
+        options: DataOptions,
         start: Optional[datetime] = None,
         stop: Optional[datetime] = None,
-        avg_period: Optional[str] = None,
     ) -> Response:
+        """
+        Return data between the start and stop dates, optionally averaged (or
+        aggregated) and/or downsampled to the requested number of points. Raw data may
+        also be streamed as newline delimited JSON if requested by the client.
+        """
         fridge_table = data_source.fridge_table()
-        if avg_period is None:
-            fridge_data = fridge_table.get_between(start, stop)
-        else:
-            fridge_data = fridge_table.avg_data(avg_period, start, stop)
-        data = self._format_data(fridge_table, fridge_data)
+        avg_period, points, columns = options.avg_period, options.points, options.columns
+        if (
+            avg_period is None
+            and points is None
+            and self._response_format(NDJSON_MIMETYPE) == NDJSON_MIMETYPE
+        ):
+            r = Response(
+                stream_with_context(self._stream_data(fridge_table, start, stop, columns)),
+                mimetype=NDJSON_MIMETYPE,
+            )
+            r.headers["Access-Control-Allow-Origin"] = "*"
+            r.headers["Cache-Control"] = "public, max-age=300"
+            return r
+
+        # Serve historical data from the cache where possible
+        cache_key = None
+        if stop is not None and current_app.config.get("RESPONSE_CACHE_SIZE", 0) > 0:
+            delay = timedelta(seconds=current_app.config.get("RESPONSE_CACHE_DELAY", 600.0))
+            if stop.astimezone() < datetime.now().astimezone() - delay:
+                cache_key = self._cache_key(data_source, options, start, stop)
+        cache = get_response_cache(current_app.config.get("RESPONSE_CACHE_SIZE", 0))
+        r = None
+        if cache_key is not None:
+            r = cache.get(
+                cache_key,
+                "gzip" in request.accept_encodings,
+                lambda cached: self._cache_valid(data_source, cached, start, stop, avg_period),
+            )
+
+        if r is None:
+            if avg_period is None:
+                fridge_data = self._get_raw(fridge_table, start, stop, points, columns)
+            else:
+                fridge_data = self._get_averaged(fridge_table, options, start, stop)
+            r = self._data_response(self._downsample(fridge_data, points, options.method))
+            if cache_key is not None:
+                # The version is read before the data, so writes made while reading
+                # invalidate the response
+                cache.put(cache_key, r, g.get("table_version") or 0)
 
         # Construct response
-        r = jsonify(data)
         r.headers["Access-Control-Allow-Origin"] = "*"
         r.headers["Cache-Control"] = "public, max-age=300"
         return r
 
+    def _cache_valid(
+        self,
+        data_source: FridgeMetadata,
+        cached: CachedResponse,
+        start: Optional[datetime],
+        stop: datetime,
+        avg_period: Optional[str],
+    ) -> bool:
+        """
+        Check that no readings in the range of a cached response have been written since
+        it was cached. Responses older than the change log can't be checked, so are
+        always recomputed.
+        """
+        if monotonic() - cached.created > CHANGE_LOG_RETENTION.total_seconds():
+            return False
+        # Responses include the whole bucket at each end of the range, and requests that
+        # share a cache entry may differ by up to a bucket at each end
+        if avg_period in MAX_PERIOD_LENGTHS:
+            width = MAX_PERIOD_LENGTHS[avg_period]
+            start = start - width if start is not None else None
+            stop = stop + width
+        return not changed_between(data_source.table_name, cached.version, start, stop)
+
+    def _cache_key(
+        self,
+        data_source: FridgeMetadata,
+        options: DataOptions,
+        start: Optional[datetime],
+        stop: datetime,
+    ) -> tuple:
+        """
+        Return the key under which a response for historical data is cached. For fixed
+        width buckets, the range is aligned to the buckets so that requests returning
+        the same buckets share a cache entry.
+        """
+        times = [time.astimezone() if time is not None else None for time in (start, stop)]
+        if options.avg_period in BUCKET_WIDTHS:
+            width = BUCKET_WIDTHS[options.avg_period].total_seconds()
+            times = [
+                int(time.timestamp() // width * width) if time is not None else None
+                for time in times
+            ]
+        return (
+            data_source.table_name,
+            *times,
+            options.avg_period,
+            options.points,
+            options.method if options.points is not None else None,
+            options.aggregates,
+            tuple(options.columns) if options.columns is not None else None,
+            self._response_format(),
+            "epoch" in request.args,
+        )
+
+    def _etag(self, data_source: FridgeMetadata, version: str) -> str:
+        """
+        Calculate an ETag for a request. Readings may be added at any time, or changed by
+        fill and merge uploads, so the ETag is based on the version of the fridge table,
+        which changes on every write.
+        """
+        validator = [
+            data_source.table_name,
+            version,
+            self._response_format(NDJSON_MIMETYPE),
+        ]
+        validator.extend(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+        if "summary" in request.args:
+            # The summary is taken over a sliding window which changes with time
+            validator.append(datetime.now().strftime("%Y%m%d%H%M"))
+        return sha1("\n".join(validator).encode("utf-8")).hexdigest()
+
+    def _not_modified(self, etag: str, modified: datetime) -> Optional[str]:
+        """
+        Check whether the client already has an up-to-date copy of the response, and if
+        so return the ETag of the copy it has. Cached responses are gzip encoded, so have
+        a different ETag to the same response without encoding.
+        """
+        if request.if_none_match:
+            for candidate in (etag, f"{etag}{GZIP_ETAG_SUFFIX}"):
+                if request.if_none_match.contains(candidate):
+                    return candidate
+            return None
+        if request.if_modified_since is not None:
+            if modified.replace(microsecond=0) <= request.if_modified_since:
+                return etag
+        return None
+
     def get(self, fridge_name, supp) -> Response:
         data_source = self._get_data_source(fridge_name, supp)
         if data_source is None:
             return Response(f"Unable to find fridge {fridge_name}, supp: {supp}.", status=404)
 
-        avg_period = request.args.get("avg_period", None)
-        if avg_period is not None:
-            if avg_period not in ("hour", "day", "month"):
-                return Response(
-                    (
-                        "Data can only be summarized by 'hour', 'day' or 'month'. "
-                        f"Requested {avg_period}."
-                    ),
-                    status=400,
-                )
-
         if "sensors" in request.args:
             return self._sensors_view(data_source)
+        if "live" in request.args:
+            return self._live_view(data_source)
+
+        # Check whether the data has changed since the client last requested it. Tables
+        # that haven't been written to since the change log was added fall back to the
+        # time of their latest reading.
+        table_version = get_version(data_source.table_name)
+        if table_version is not None:
+            g.table_version = table_version.version
+            version, modified = f"v{table_version.version}", table_version.changed
+        else:
+            modified = data_source.fridge_table().latest_time()
+            if modified is None:
+                r = self._data_view(data_source)
+                r.headers["Vary"] = DATA_VARY
+                return r
+            version = modified.isoformat()
+        if "summary" in request.args:
+            # The summary also changes every minute, as in the ETag
+            now = datetime.now().astimezone().replace(second=0, microsecond=0)
+            modified = max(modified, now)
+        etag = self._etag(data_source, version)
+        matched = self._not_modified(etag, modified)
+        if matched is not None:
+            r = Response(status=304)
+            r.headers["Access-Control-Allow-Origin"] = "*"
+            etag = matched
+        else:
+            r = self._data_view(data_source)
+            if r.status_code != 200:
+                return r
+            if r.content_encoding == "gzip":
+                etag = f"{etag}{GZIP_ETAG_SUFFIX}"
+        r.headers["Vary"] = DATA_VARY
+        r.set_etag(etag)
+        r.last_modified = modified
+        return r
+
+    def _data_view(self, data_source: FridgeMetadata) -> Response:
+        """
+        Return the data requested by the query parameters
+        """
+        try:
+            options = parse_data_options(data_source)
+        except ValueError as e:
+            return Response(str(e), status=400)
+
         if "current" in request.args:
-            return self._current_view(data_source)
+            return self._current_view(data_source, options.columns)
         if "summary" in request.args:
-            return self._summary_view(data_source)
+            return self._summary_view(data_source, options.avg_period, options.columns)
+        if "stats" in request.args:
+            return self._parse_stats(data_source, options)
+        return self._history_view(data_source, options)
+
+    def _history_view(self, data_source: FridgeMetadata, options: DataOptions) -> Response:
+        """
+        Return the data added since a given time, the latest data, or the data in a
+        range of time
+        """
+        count = None
         if "count" in request.args:
             try:
                 count = int(request.args["count"])
+                if count <= 0:
+                    raise ValueError("Count must be positive")
             except ValueError:
                 return Response(
                     f"Count must be a positive integer. Got {request.args['count']}",
                     status=400,
                 )
-            return self._count_view(data_source, count, avg_period=avg_period)
-        if "start" in request.args and "stop" in request.args:
+        if "since" in request.args:
+            return self._parse_since(data_source, count, options.columns)
+        if count is not None:
+            return self._count_view(data_source, count, options)
+        if "start" in request.args or "stop" in request.args or "limit" in request.args:
+            return self._range_view(data_source, options)
+        if options.avg_period is not None:
+            # Can also return all data if we're asking for averaged data
+            return self._date_view(data_source, options)
+        return Response("Unknown request", status=421)
+
+    def _parse_since(
+        self,
+        data_source: FridgeMetadata,
+        count: Optional[int] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Response:
+        """
+        Validate the cursor of a request for the data added since a given time
+        """
+        # The cursor returned by a previous request also contains the table version
+        since_time, _, version = request.args["since"].partition("@")
+        try:
+            since = parse_request_time(since_time)
+            since_version = int(version) if version else None
+        except ValueError:
+            return Response("Invalid since date.", status=400)
+        return self._since_view(data_source, since, since_version, count, columns)
+
+    def _range_view(self, data_source: FridgeMetadata, options: DataOptions) -> Response:
+        """
+        Validate the arguments for the data in a range of time
+        """
+        try:
+            start, stop = parse_date_range(
+                "Both start and stop must be provided when requesting a date range"
+            )
+        except ValueError as e:
+            return Response(str(e), status=400)
+        if "limit" in request.args:
+            return self._paginated_view(data_source, start, stop, options)
+        if options.avg_period == "auto":
+            avg_period = choose_period(stop - start, options.points or AUTO_PERIOD_POINTS)
+            options = replace(options, avg_period=avg_period)
+        if stop - start > MAX_RAW_INTERVAL and options.avg_period is None:
+            return Response(
+                (
+                    "An averaging period must be given for intervals longer than "
+                    f"{MAX_RAW_INTERVAL.days} days, "
+                    "or the data must be paginated using limit. "
+                    f"Requested interval: {str(stop - start)}"
+                ),
+                status=400,
+            )
+        return self._date_view(data_source, options, start, stop)
+
+    def _parse_stats(self, data_source: FridgeMetadata, options: DataOptions) -> Response:
+        """
+        Validate the arguments for statistics of the data
+        """
+        try:
+            start, stop = parse_date_range("Both start and stop must be provided for statistics")
+        except ValueError as e:
+            return Response(str(e), status=400)
+        if stop - start > MAX_RAW_INTERVAL:
+            # Percentiles are calculated by sorting every raw reading in the interval
+            return Response(
+                (
+                    "Statistics can only be calculated over intervals of up to "
+                    f"{MAX_RAW_INTERVAL.days} days. Requested interval: {str(stop - start)}"
+                ),
+                status=400,
+            )
+        if options.avg_period == "auto":
+            avg_period = choose_period(stop - start, options.points or AUTO_PERIOD_POINTS)
+            options = replace(options, avg_period=avg_period)
+
+        percentiles = DEFAULT_PERCENTILES
+        if "percentiles" in request.args:
             try:
-                try:
-                    start = datetime.fromisoformat(request.args["start"])
-                except ValueError:
-                    start_timestamp = float(request.args["start"])
-                    # Detect javascript timestamps
-                    if start_timestamp > 10_000_000_000:
-                        start_timestamp /= 1000
-                    start = datetime.fromtimestamp(start_timestamp)
-                try:
-                    stop = datetime.fromisoformat(request.args["stop"])
-                except ValueError:
-                    stop_timestamp = float(request.args["stop"])
-                    if stop_timestamp > 10_000_000_000:
-                        stop_timestamp /= 1000
-                    stop = datetime.fromtimestamp(stop_timestamp)
+                percentiles = tuple(float(p) for p in request.args["percentiles"].split(","))
+                if not all(0 <= percentile <= 100 for percentile in percentiles):
+                    raise ValueError("Percentiles out of range")
             except ValueError:
-                return Response("Invalid start or stop date.", status=400)
-
-            if start >= stop:
                 return Response(
-                    f"Start occurs after stop ({start.isoformat()} - {stop.isoformat()})",
-                    status=400,
-                )
-            if stop - start > timedelta(days=30) and avg_period is None:
-                return Response(
-                    (
-                        "An averaging period must be given for intervals longer than 30 days. "
-                        f"Requested interval: {str(stop - start)}"
-                    ),
+                    "Percentiles must be a list of numbers between 0 and 100. "
+                    f"Got {request.args['percentiles']}",
                     status=400,
                 )
+        return self._stats_view(data_source, start, stop, options, percentiles)
 
-            return self._date_view(data_source, start, stop, avg_period=avg_period)
-        if "start" in request.args or "stop" in request.args:
+    def _paginated_view(
+        self,
+        data_source: FridgeMetadata,
+        start: datetime,
+        stop: datetime,
+        options: DataOptions,
+    ) -> Response:
+        """
+        Validate the arguments for a page of raw data
+        """
+        if options.avg_period is not None or options.points is not None:
             return Response(
-                "Both start and stop must be provided when requesting a date range",
+                "Only raw data can be paginated. Remove avg_period and points.", status=400
+            )
+        try:
+            limit = int(request.args["limit"])
+            if not 0 < limit <= MAX_PAGE_LIMIT:
+                raise ValueError("Limit out of range")
+        except ValueError:
+            return Response(
+                f"Limit must be an integer between 1 and {MAX_PAGE_LIMIT}. "
+                f"Got {request.args['limit']}",
                 status=400,
             )
-        if avg_period is not None:
-            # Can also return all data if we're asking for averaged data
-            return self._date_view(data_source, avg_period=avg_period)
-
-        return Response("Unknown request", status=421)
-
-    def post(self, fridge_name, supp) -> Response:
-        data_source = self._get_data_source(fridge_name, supp)
-        if data_source is None:
-            return Response(f"Unable to find fridge {fridge_name}, supp: {supp}.", status=404)
+        after = None
+        if "after" in request.args:
+            try:
+                after = parse_request_time(request.args["after"])
+            except ValueError:
+                return Response("Invalid after cursor.", status=400)
+        return self._page_view(data_source, start, stop, limit, after, options.columns)
 
+    def _check_upload_fields(self, data_source: FridgeMetadata, field_names: Iterable[str]):
+        """
+        Check that each uploaded field is either the time or a sensor of the data source.
+        Raises ValueError with a message suitable to return to the client otherwise.
+        """
         valid_sensors = set(sensor.column_name for sensor in data_source.sensors)
+        for field_name in field_names:
+            if field_name.lower() != "time" and field_name not in valid_sensors:
+                raise ValueError(f"Sensor {field_name} not found in {data_source.name}")
 
-        # Put the data in a json array
-        data: dict[str, float | datetime] = {}
-        for field_name, value in request.form.items():
+    def _parse_upload(self, row: Mapping[str, Any]) -> dict[str, Optional[float] | datetime]:
+        """
+        Convert a row of uploaded values into the types stored in the database.
+        Raises ValueError with a message suitable to return to the client if a value
+        is invalid.
+        """
+        data: dict[str, Optional[float] | datetime] = {}
+        for field_name, value in row.items():
             # Convert all variants of time to lowercase time, and convert into timestamp
             if field_name.lower() == "time":
                 try:
-                    data["time"] = datetime.fromisoformat(value)
-                except ValueError:
-                    try:
-                        data["time"] = datetime.fromtimestamp(float(value))
-                    except ValueError:
-                        return Response(f"Invalid time format: {data['time']}", status=400)
-            elif field_name not in valid_sensors:
-                return Response(f"Sensor {field_name} not found in {data_source.name}", status=400)
+                    data["time"] = _parse_upload_time(value)
+                except (TypeError, ValueError) as exc:
+                    raise ValueError(f"Invalid time format: {value}") from exc
+            elif value is None:
+                data[field_name] = None
             else:
                 try:
                     data[field_name] = float(value)
-                except ValueError:
-                    return Response(f"Invalid value for field {field_name}: {value!r}", status=400)
+                except (TypeError, ValueError) as exc:
+                    raise ValueError(f"Invalid value for field {field_name}: {value!r}") from exc
+        return data
+
+    def _batch_post(self, data_source: FridgeMetadata, on_conflict: str) -> Response:
+        """
+        Add many rows to the database at once. Rows can be given either as a JSON
+        array of objects, or as newline delimited JSON objects.
+        """
+        rows: Any
+        if request.mimetype == NDJSON_MIMETYPE:
+            body = request.get_data(as_text=True)
+            try:
+                rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+            except ValueError:
+                return Response("Unable to parse uploaded JSON", status=400)
+        else:
+            rows = request.get_json(silent=True)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return Response("Batch uploads must be a list of objects", status=400)
+
+        # Check the columns of the whole batch at once
+        try:
+            self._check_upload_fields(data_source, set(field for row in rows for field in row))
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+        data = []
+        for i, row in enumerate(rows):
+            try:
+                parsed = self._parse_upload(row)
+            except ValueError as e:
+                return Response(f"Row {i}: {e}", status=400)
+            if "time" not in parsed:
+                return Response(f"Row {i}: Each row in a batch upload must have a time", status=400)
+            data.append(parsed)
 
         # Add to db
+        if current_app.config.get("WRITE_DURABILITY", "sync") != "sync":
+            return self._buffered_post(data_source, data, on_conflict, batch=True)
+        try:
+            accepted = data_source.fridge_table().append_many(data, on_conflict=on_conflict)
+        except KeyError as e:
+            return Response(str(e), status=400)
+        return jsonify({"accepted": accepted, "duplicate": len(data) - accepted})
+
+    def _buffered_post(
+        self,
+        data_source: FridgeMetadata,
+        data: list[dict[str, Any]],
+        on_conflict: str,
+        batch: bool = False,
+    ) -> Response:
+        """
+        Queue rows in the write buffer, to be written along with other uploads. Depending
+        on the durability mode, we either wait for them to be committed or return
+        immediately. Since the rows are written together with other uploads, we don't
+        know which were duplicates.
+        """
+        durability = current_app.config["WRITE_DURABILITY"]
+        buffer = get_write_buffer(current_app)
+        for row in data:
+            # Readings without a time are taken at the time they are uploaded
+            row.setdefault("time", datetime.now().astimezone())
         try:
-            result = data_source.fridge_table().append(**data)
+            buffer.submit(
+                data_source.fridge_table(),
+                data,
+                on_conflict=on_conflict,
+                wait=durability == "group",
+            )
+        except (QueueFull, WriteTimeout) as e:
+            r = Response(str(e), status=503)
+            r.headers["Retry-After"] = "1"
+            return r
+        except KeyError as e:
+            return Response(str(e), status=400)
+        # Readings that haven't been written yet are only accepted for processing
+        status = 202 if durability == "async" else 200
+        r = jsonify({"queued": len(data)}) if batch else Response("OK")
+        r.status_code = status
+        return r
+
+    def post(self, fridge_name, supp) -> Response:
+        data_source = self._get_data_source(fridge_name, supp)
+        if data_source is None:
+            return Response(f"Unable to find fridge {fridge_name}, supp: {supp}.", status=404)
+
+        # Readings at an existing timestamp are ignored unless asked otherwise
+        on_conflict = request.args.get("on_conflict", "ignore")
+        if on_conflict not in CONFLICT_MODES:
+            return Response(
+                f"Invalid on_conflict {on_conflict}. Must be one of {', '.join(CONFLICT_MODES)}",
+                status=400,
+            )
+
+        if request.is_json or request.mimetype == NDJSON_MIMETYPE:
+            return self._batch_post(data_source, on_conflict)
+
+        # Put the data in a json array
+        try:
+            self._check_upload_fields(data_source, request.form.keys())
+            data = self._parse_upload(request.form)
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+        # Add to db
+        if current_app.config.get("WRITE_DURABILITY", "sync") != "sync":
+            return self._buffered_post(data_source, [data], on_conflict)
+        try:
+            result = data_source.fridge_table().append(on_conflict=on_conflict, **data)
             if result:
                 return Response("OK")
             return Response("OK but duplicate")
@@ -281,6 +920,58 @@ class FridgeView(MethodView):
             return Response(str(e), status=400)
 
 
+class FleetView(MethodView):
+    def _format_reading(self, reading: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+        """
+        Replace invalid values in a reading with None. Postgres encodes NaN and inf
+        values as strings in JSON.
+        """
+        if reading is None:
+            return None
+        for k, val in reading.items():
+            if k != "time" and not isinstance(val, (int, float)):
+                reading[k] = None
+        return reading
+
+    def get(self) -> Response:
+        """
+        Return the current data from every enabled fridge, along with the current data
+        from each of their supplementary datasets.
+        """
+        fleet = get_fleet_metadata()
+        tables = []
+        for fridge, supps in fleet:
+            tables.append(fridge.fridge_table())
+            tables.extend(supp.fridge_table() for supp in supps)
+        latest = get_last_many(tables)
+
+        data = {}
+        for fridge, supps in fleet:
+            data[fridge.name] = {
+                "label": fridge.label,
+                "current": self._format_reading(latest[fridge.table_name]),
+                "supp": {
+                    supp.name: {
+                        "label": supp.label,
+                        "current": self._format_reading(latest[supp.table_name]),
+                    }
+                    for supp in supps
+                },
+            }
+
+        # Construct response
+        r = jsonify(data)
+        r.headers["Access-Control-Allow-Origin"] = "*"
+        r.headers["Cache-Control"] = "public, max-age=5"
+        return r
+
+
+# Fridge names can't contain a slash, so this can't be mistaken for the route of a fridge
+fridge_bp.add_url_rule(
+    "/fleet/current",
+    endpoint="fleet_view",
+    view_func=FleetView.as_view("fleet_view"),
+)
 fridge_bp.add_url_rule(
     "/<fridge_name>/supp/<supp>",
     endpoint="fridge_supp_view",
@@ -292,3 +983,14 @@ fridge_bp.add_url_rule(
     endpoint="fridge_view",
     view_func=FridgeView.as_view("fridge_view"),
 )
+fridge_bp.add_url_rule(
+    "/<fridge_name>/supp/<supp>/export",
+    endpoint="fridge_supp_export",
+    view_func=ExportView.as_view("fridge_export"),
+)
+fridge_bp.add_url_rule(
+    "/<fridge_name>/export",
+    defaults={"supp": None},
+    endpoint="fridge_export",
+    view_func=ExportView.as_view("fridge_export"),
+)
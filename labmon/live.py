@@ -0,0 +1,114 @@
+"""
+Fan out new readings to clients of the live stream. Each worker process holds a
+single connection to the database which LISTENs on the channels of the tables that
+clients are subscribed to, and passes each notification on to every subscriber.
+"""
+
+import logging
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import sleep
+from typing import Optional
+
+import psycopg
+from psycopg import sql
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of readings buffered for a client before new readings are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+# How often the listener checks for new subscriptions, in seconds
+POLL_INTERVAL = 1.0
+# How long to wait before reconnecting after losing the connection, in seconds
+RECONNECT_INTERVAL = 5.0
+
+_listener: Optional["ReadingListener"] = None
+_listener_lock = Lock()
+
+
+class TooManySubscribers(Exception):
+    """
+    Raised when the maximum number of live streams are already open in this process
+    """
+
+
+class ReadingListener:
+    def __init__(self, conninfo: str):
+        self.conninfo = conninfo
+        self._subscribers: dict[str, set[Queue]] = {}
+        self.n_subscribers = 0
+        self._lock = Lock()
+        self._thread = Thread(target=self._run, name="labmon-live-listener", daemon=True)
+        self._thread.start()
+
+    def subscribe(self, channel: str, max_subscribers: Optional[int] = None) -> Queue:
+        """
+        Subscribe to new readings published on a channel. Readings are put on the
+        returned queue as JSON strings. Raises TooManySubscribers if there are already
+        max_subscribers subscriptions.
+        """
+        queue: Queue = Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if max_subscribers is not None and self.n_subscribers >= max_subscribers:
+                raise TooManySubscribers(f"The limit of {max_subscribers} live streams is reached")
+            self._subscribers.setdefault(channel, set()).add(queue)
+            self.n_subscribers += 1
+        return queue
+
+    def unsubscribe(self, channel: str, queue: Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, set())
+            if queue in subscribers:
+                subscribers.discard(queue)
+                self.n_subscribers -= 1
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+
+    def _publish(self, channel: str, payload: str):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for queue in subscribers:
+            try:
+                queue.put_nowait(payload)
+            except Full:
+                # Drop readings for clients that aren't keeping up
+                pass
+
+    def _listen(self):
+        listening: set[str] = set()
+        with psycopg.connect(self.conninfo, autocommit=True) as conn:
+            while True:
+                # Update the set of channels we are listening on
+                with self._lock:
+                    channels = set(self._subscribers)
+                for channel in channels - listening:
+                    conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                for channel in listening - channels:
+                    conn.execute(sql.SQL("UNLISTEN {}").format(sql.Identifier(channel)))
+                listening = channels
+
+                for notify in conn.notifies(timeout=POLL_INTERVAL):
+                    self._publish(notify.channel, notify.payload)
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg.Error as e:
+                logger.error(
+                    "Lost connection for live updates. Reconnecting in %.0f s.",
+                    RECONNECT_INTERVAL,
+                    exc_info=e,
+                )
+                sleep(RECONNECT_INTERVAL)
+
+
+def get_listener(conninfo: str) -> ReadingListener:
+    """
+    Return the listener for this process, starting it if necessary
+    """
+    global _listener  # pylint: disable=global-statement
+    with _listener_lock:
+        if _listener is None:
+            _listener = ReadingListener(conninfo)
+        return _listener
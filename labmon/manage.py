@@ -0,0 +1,210 @@
+"""
+Database maintenance commands for the monitoring server. Run with
+python -m labmon.manage <command>, from an environment with the server configured.
+"""
+
+import argparse
+import logging
+from typing import Iterable, Optional
+
+from . import create_app
+from .db import Fridge, db
+from .db.abc import FridgeModel
+from .db.changes import CHANGE_LOG_RETENTION, prune_changes
+from .db.migrate import migrate_table
+from .db.rollups import create_rollups, drop_rollups
+from .db.storage import (
+    apply_storage_policies,
+    check_storage_policies,
+    get_storage_stats,
+    is_hypertable,
+)
+from .utility.logging import set_logging
+from .utility.si_prefix import si_format
+
+logger = logging.getLogger(__name__)
+
+
+def get_models(fridge_names: Optional[list[str]] = None) -> Iterable[FridgeModel]:
+    """
+    Return each fridge, along with each of its supplementary datasets. If fridge_names
+    is given, only those fridges are returned.
+    """
+    if fridge_names:
+        fridges = [Fridge.get_fridge_by_name(name) for name in fridge_names]
+    else:
+        fridges = db.session.scalars(db.select(Fridge).order_by(Fridge.view_order)).all()
+    for fridge in fridges:
+        yield fridge
+        yield from fridge.supplementary
+
+
+def rollups(args: argparse.Namespace):
+    """
+    Create (or drop) the hourly and daily rollups of each fridge table
+    """
+    for model in get_models(args.fridges):
+        try:
+            fridge_table = model.fridge_table()
+        except KeyError as e:
+            logger.warning("Skipping %s: %s", model.name, e)
+            continue
+        if args.drop:
+            drop_rollups(fridge_table)
+        else:
+            create_rollups(fridge_table, refresh=not args.no_refresh)
+
+
+def storage(args: argparse.Namespace):
+    """
+    Apply the compression and retention policies of each fridge table, optionally updating
+    them first, then report the size of each table. Tables that aren't hypertables are
+    skipped.
+    """
+    models = list(get_models(args.fridges))
+    for model in models:
+        # "none" disables a policy
+        if args.compress_after is not None:
+            model.compress_after = None if args.compress_after == "none" else args.compress_after
+        if args.retain_raw is not None:
+            model.retain_raw = None if args.retain_raw == "none" else args.retain_raw
+        # Check the new policies before they are stored
+        try:
+            check_storage_policies(model.table_name, model.compress_after, model.retain_raw)
+        except ValueError as e:
+            db.session.rollback()
+            logger.error("%s", e)
+            return
+    db.session.commit()
+
+    print(f"{'Table':<32} {'Size':>9} {'Compressed':>12} {'Before':>9} {'After':>9} {'Ratio':>6}")
+    for model in models:
+        if not is_hypertable(model.table_name):
+            print(f"{model.table_name:<32} {'not a hypertable':>48}")
+            continue
+        if not args.report:
+            apply_storage_policies(model.table_name, model.compress_after, model.retain_raw)
+        stats = get_storage_stats(model.table_name)
+        chunks = f"{stats.compressed_chunks}/{stats.total_chunks}"
+        ratio = "-" if stats.compression_ratio is None else f"{stats.compression_ratio:.1f}x"
+        print(
+            f"{stats.table_name:<32} {_format_bytes(stats.total_bytes):>9} {chunks:>12} "
+            f"{_format_bytes(stats.before_compression_bytes):>9} "
+            f"{_format_bytes(stats.after_compression_bytes):>9} {ratio:>6}"
+        )
+
+
+def migrate(args: argparse.Namespace):
+    """
+    Rebuild each fridge table as a new table, while uploads continue
+    """
+    for model in get_models(args.fridges):
+        migrate_table(
+            model.fridge_table(check_exists=False),
+            chunk_rows=args.chunk_rows,
+            pause=args.pause,
+            hypertable=not args.no_hypertable,
+            restart=args.restart,
+            compress_after=model.compress_after,
+            retain_raw=model.retain_raw,
+        )
+
+
+def changes(args: argparse.Namespace):  # pylint: disable=unused-argument
+    """
+    Remove old entries from the log of writes to the fridge tables. Run this regularly,
+    e.g. daily from cron.
+    """
+    removed = prune_changes()
+    logger.info(
+        "Removed %d changes older than %s from the change log", removed, CHANGE_LOG_RETENTION
+    )
+
+
+def _format_bytes(size: int) -> str:
+    value = si_format(size).rstrip()
+    return f"{value}B" if value[-1].isalpha() else f"{value} B"
+
+
+def main():
+    """
+    Parse the command line, and run the given command
+    """
+    cmd_args = argparse.ArgumentParser(description="LabMon Database Maintenance")
+    cmd_args.add_argument("-v", "--verbose", nargs="?", const=".", default=None)
+    commands = cmd_args.add_subparsers(dest="command", required=True)
+
+    rollup_args = commands.add_parser("rollups", help="Create the rollups of averaged data")
+    rollup_args.add_argument("fridges", nargs="*", help="Fridges to update (default: all)")
+    rollup_args.add_argument("--drop", action="store_true", help="Remove the rollups instead")
+    rollup_args.add_argument(
+        "--no-refresh",
+        action="store_true",
+        help="Don't fill the rollups with existing data (they are filled in the background)",
+    )
+    rollup_args.set_defaults(func=rollups)
+
+    storage_args = commands.add_parser(
+        "storage", help="Apply compression and retention policies, and report table sizes"
+    )
+    storage_args.add_argument("fridges", nargs="*", help="Fridges to update (default: all)")
+    storage_args.add_argument(
+        "--compress-after",
+        metavar="INTERVAL",
+        help='Set the age after which chunks are compressed, e.g. "30 days", or "none"',
+    )
+    storage_args.add_argument(
+        "--retain-raw",
+        metavar="INTERVAL",
+        help='Set the age after which raw readings are dropped, e.g. "2 years", or "none"',
+    )
+    storage_args.add_argument(
+        "--report", action="store_true", help="Only report the size of each table"
+    )
+    storage_args.set_defaults(func=storage)
+
+    migrate_args = commands.add_parser(
+        "migrate",
+        help="Copy each fridge table into a new hypertable, resuming if interrupted "
+        "(requires scripts/add_change_log.sql and scripts/add_storage_policies.sql)",
+    )
+    migrate_args.add_argument("fridges", nargs="*", help="Fridges to migrate (default: all)")
+    migrate_args.add_argument(
+        "--chunk-rows", type=int, default=100_000, help="Number of rows to copy at a time"
+    )
+    migrate_args.add_argument(
+        "--pause", type=float, default=0.0, help="Seconds to wait between each chunk"
+    )
+    migrate_args.add_argument(
+        "--no-hypertable", action="store_true", help="Create a plain table rather than a hypertable"
+    )
+    migrate_args.add_argument(
+        "--restart", action="store_true", help="Discard the progress of a previous migration"
+    )
+    migrate_args.set_defaults(func=migrate)
+
+    changes_args = commands.add_parser(
+        "changes", help="Remove old entries from the change log (run e.g. daily)"
+    )
+    changes_args.set_defaults(func=changes)
+
+    parsed_args = cmd_args.parse_args(namespace=argparse.Namespace())
+
+    if parsed_args.verbose is not None:
+        if parsed_args.verbose == ".":
+            # Set log level debug on labmon
+            set_logging(logging.DEBUG)
+        else:
+            set_logging(logging.DEBUG, parsed_args.verbose)
+    else:
+        set_logging(logging.INFO)
+
+    app = create_app()
+    with app.app_context():
+        parsed_args.func(parsed_args)
+
+
+if __name__ == "__main__":
+    # If we are here - override the name of the default logger
+    logger = logging.getLogger("labmon.manage")
+    main()
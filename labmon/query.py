@@ -0,0 +1,141 @@
+"""
+Parsing of the query arguments of requests for fridge data. Invalid arguments raise a
+ValueError with a message suitable to return to the client.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from flask import request
+
+from .db import FridgeMetadata
+from .db.fridge_table import AGGREGATES, AVG_PERIODS
+from .utility.downsample import DOWNSAMPLE_METHODS
+
+
+@dataclass
+class DataOptions:
+    """
+    How the requested data is averaged or aggregated and downsampled, and which of
+    the sensors are returned
+    """
+
+    avg_period: Optional[str] = None
+    aggregates: Optional[tuple[str, ...]] = None
+    points: Optional[int] = None
+    method: str = "lttb"
+    columns: Optional[list[str]] = None
+
+
+def parse_request_time(value: str) -> datetime:
+    """
+    Convert a time given in a request, either as an ISO formatted string or a
+    timestamp in seconds or milliseconds, into a datetime.
+    Raises ValueError if the time is invalid.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        timestamp = float(value)
+        # Detect javascript timestamps
+        if timestamp > 10_000_000_000:
+            timestamp /= 1000
+        return datetime.fromtimestamp(timestamp)
+
+
+def parse_date_range(missing: str) -> tuple[datetime, datetime]:
+    """
+    Return the start and stop dates of the request. Raises ValueError with the given
+    message if either is missing.
+    """
+    if "start" not in request.args or "stop" not in request.args:
+        raise ValueError(missing)
+    try:
+        start = parse_request_time(request.args["start"])
+        stop = parse_request_time(request.args["stop"])
+    except ValueError:
+        raise ValueError("Invalid start or stop date.") from None
+    if start >= stop:
+        raise ValueError(f"Start occurs after stop ({start.isoformat()} - {stop.isoformat()})")
+    return start, stop
+
+
+def parse_columns(data_source: FridgeMetadata) -> Optional[list[str]]:
+    """
+    Return the sensor columns requested by the columns argument, or None to request
+    all sensors. Raises a KeyError if any of the columns aren't sensors of the fridge.
+    """
+    if "columns" not in request.args:
+        return None
+    # Keep the requested order, ignoring any repeated columns
+    columns = list(dict.fromkeys(request.args["columns"].split(",")))
+    sensor_names = {sensor.column_name for sensor in data_source.sensors}
+    unknown = [column for column in columns if column not in sensor_names]
+    if unknown:
+        raise KeyError(", ".join(unknown))
+    return columns
+
+
+def _parse_avg_period() -> Optional[str]:
+    avg_period = request.args.get("avg_period", None)
+    if avg_period is None:
+        return None
+    if avg_period not in AVG_PERIODS and avg_period != "auto":
+        raise ValueError(
+            f"Data can only be summarized by {', '.join(AVG_PERIODS)} or auto. "
+            f"Requested {avg_period}."
+        )
+    if avg_period == "auto" and (
+        "summary" in request.args or "start" not in request.args or "stop" not in request.args
+    ):
+        raise ValueError("Both start and stop must be provided to choose an averaging period")
+    return avg_period
+
+
+def _parse_aggregates(avg_period: Optional[str]) -> Optional[tuple[str, ...]]:
+    if "agg" not in request.args:
+        return None
+    aggregates = tuple(request.args["agg"].split(","))
+    if not set(aggregates) <= set(AGGREGATES):
+        raise ValueError(
+            f"Data can only be aggregated using {', '.join(AGGREGATES)}. "
+            f"Requested {request.args['agg']}."
+        )
+    if avg_period is None:
+        raise ValueError("An averaging period must be given to aggregate data")
+    return aggregates
+
+
+def _parse_points() -> Optional[int]:
+    if "points" not in request.args:
+        return None
+    try:
+        points = int(request.args["points"])
+        if points < 3:
+            raise ValueError("Too few points")
+    except ValueError:
+        raise ValueError(
+            f"Points must be an integer of at least 3. Got {request.args['points']}"
+        ) from None
+    return points
+
+
+def parse_data_options(data_source: FridgeMetadata) -> DataOptions:
+    """
+    Return the options given by the query arguments of a request for data
+    """
+    avg_period = _parse_avg_period()
+    aggregates = _parse_aggregates(avg_period)
+    points = _parse_points()
+    method = request.args.get("downsample", "lttb")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(
+            f"Data can only be downsampled using {', '.join(DOWNSAMPLE_METHODS)}. "
+            f"Requested {method}."
+        )
+    try:
+        columns = parse_columns(data_source)
+    except KeyError as e:
+        raise ValueError(f"Unknown columns: {e.args[0]}") from None
+    return DataOptions(avg_period, aggregates, points, method, columns)
@@ -0,0 +1,65 @@
+"""
+Compact columnar binary encoding of sensor data, for clients that want to avoid the
+cost of JSON. All values are little-endian, and every block is padded to a multiple of
+8 bytes so that clients can view the arrays directly (e.g. as a Float64Array).
+
+Layout:
+    magic       4 bytes, b"LMC1"
+    n_rows      uint32
+    n_cols      uint32, number of sensor columns (excluding time)
+    names       n_cols * (uint16 length, utf-8 name), padded
+    time        n_rows * int64, milliseconds since the epoch
+    For each sensor column, in the same order as names:
+        validity    ceil(n_rows / 8) bytes, padded. Bit i (LSB first) is set if
+                    row i holds a valid reading.
+        values      n_rows * float64, with missing readings stored as NaN
+"""
+
+import struct
+import sys
+from array import array
+from datetime import datetime
+from typing import Mapping, Optional, Sequence
+
+COLUMNAR_MIMETYPE = "application/vnd.labmon.columnar"
+MAGIC = b"LMC1"
+
+
+def _pad(buf: bytearray):
+    buf.extend(bytes(-len(buf) % 8))
+
+
+def _to_le(arr: array) -> bytes:
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def pack_columns(
+    times: Sequence[datetime], columns: Mapping[str, Sequence[Optional[float]]]
+) -> bytes:
+    """
+    Pack a time axis and the sensor columns that share it into the columnar format.
+    """
+    n_rows = len(times)
+    buf = bytearray(MAGIC)
+    buf.extend(struct.pack("<II", n_rows, len(columns)))
+    for name in columns:
+        encoded = name.encode("utf-8")
+        buf.extend(struct.pack("<H", len(encoded)))
+        buf.extend(encoded)
+    _pad(buf)
+
+    buf.extend(_to_le(array("q", (round(time.timestamp() * 1000) for time in times))))
+
+    nan = float("nan")
+    for values in columns.values():
+        validity = bytearray((n_rows + 7) // 8)
+        for i, val in enumerate(values):
+            # x - x is only zero for finite x
+            if val is not None and val - val == 0:
+                validity[i >> 3] |= 1 << (i & 7)
+        buf.extend(validity)
+        _pad(buf)
+        buf.extend(_to_le(array("d", (nan if val is None else val for val in values))))
+    return bytes(buf)
@@ -0,0 +1,139 @@
+"""
+Pure python downsampling of time series for display. Multiple series sharing the same
+time axis are reduced together: each series is scaled to its range, and the points are
+chosen from the combined series, so that at most the requested number of points is
+returned however many series there are. Both methods return the indices of the points
+that should be kept.
+"""
+
+from math import isinf, isnan
+from typing import Optional, Sequence
+
+DOWNSAMPLE_METHODS = ("lttb", "minmax")
+
+Series = Sequence[Optional[float]]
+
+
+def _valid(value: Optional[float]) -> bool:
+    return value is not None and not (isnan(value) or isinf(value))
+
+
+def _normalize(series: Sequence[Series]) -> list[list[Optional[float]]]:
+    """
+    Scale each series to the range [0, 1], replacing invalid (None, NaN or inf) values
+    with None. Series with no valid values are dropped.
+    """
+    normalized = []
+    for values in series:
+        valid = [val for val in values if _valid(val)]
+        if not valid:
+            continue
+        low, high = min(valid), max(valid)  # type: ignore
+        scale = (high - low) or 1.0
+        normalized.append([(val - low) / scale if _valid(val) else None for val in values])
+    return normalized
+
+
+def lttb(x: Sequence[float], series: Sequence[Series], threshold: int) -> list[int]:
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices of (at most)
+    `threshold` points that best preserve the visual shape of the series. The area of
+    each triangle is summed over the series, skipping invalid values.
+    """
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return list(range(size))
+
+    # Bucket size, leaving room for the first and last points
+    every = (size - 2) / (threshold - 2)
+    sampled = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Average point of each series in the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, size)
+        avg_x = sum(x[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_ys = []
+        for values in series:
+            valid = [val for val in values[avg_start:avg_end] if val is not None]
+            avg_ys.append(sum(valid) / len(valid) if valid else None)
+
+        # Find the point in this bucket that forms the largest triangles with
+        # the previously selected point and the average of the next bucket
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        ax = x[a]
+        max_area = -1.0
+        max_idx = range_start
+        for j in range(range_start, range_end):
+            area = 0.0
+            for values, avg_y in zip(series, avg_ys):
+                ay, y = values[a], values[j]
+                if ay is None or y is None or avg_y is None:
+                    continue
+                area += abs((ax - avg_x) * (y - ay) - (ax - x[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                max_idx = j
+        sampled.append(max_idx)
+        a = max_idx
+    sampled.append(size - 1)
+    return sampled
+
+
+def minmax(series: Sequence[Series], threshold: int) -> list[int]:
+    """
+    Min/max envelope downsampling. The series are split into threshold // 2 buckets,
+    and the minimum and maximum of the series with the largest range in each bucket
+    is kept, in order. Invalid values are skipped.
+    """
+    size = len(series[0]) if series else 0
+    if threshold >= size:
+        return list(range(size))
+    n_buckets = threshold // 2
+    if n_buckets < 1:
+        return []
+
+    every = size / n_buckets
+    sampled = []
+    for i in range(n_buckets):
+        start = int(i * every)
+        end = min(int((i + 1) * every), size)
+        extremes = None
+        for values in series:
+            valid = [j for j in range(start, end) if values[j] is not None]
+            if not valid:
+                continue
+            min_idx = min(valid, key=values.__getitem__)
+            max_idx = max(valid, key=values.__getitem__)
+            spread = values[max_idx] - values[min_idx]  # type: ignore
+            if extremes is None or spread > extremes[0]:
+                extremes = (spread, min_idx, max_idx)
+        if extremes is not None:
+            sampled.extend(sorted({extremes[1], extremes[2]}))
+    return sampled
+
+
+def downsample(
+    x: Sequence[float],
+    series: Sequence[Series],
+    threshold: int,
+    method: str = "lttb",
+) -> list[int]:
+    """
+    Downsample the series sharing the time axis `x` together, returning the sorted
+    indices of at most `threshold` points to keep. Missing (None, NaN or inf) values
+    are ignored when selecting points.
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unknown downsampling method {method}")
+    if threshold >= len(x):
+        return list(range(len(x)))
+
+    normalized = _normalize(series)
+    if method == "lttb":
+        return lttb(x, normalized, threshold)
+    # Always keep the end points so that the range of the data is preserved
+    keep = {0, len(x) - 1}
+    keep.update(minmax(normalized, threshold - 2))
+    return sorted(keep)
@@ -0,0 +1,30 @@
+"""
+Fast JSON encoding of columns of sensor data using orjson. orjson encodes NaN and infinite
+readings as null and datetimes as ISO formatted strings itself, so columns can be passed
+to it directly rather than checking and converting each value in python.
+"""
+
+from array import array
+from datetime import datetime
+from typing import Mapping, Optional, Sequence
+
+import orjson
+
+
+def dumps_columns(
+    times: Sequence[datetime],
+    columns: Mapping[str, Sequence[Optional[float]]],
+    epoch: bool = False,
+) -> bytes:
+    """
+    Encode a time axis and the sensor columns that share it as a JSON object mapping
+    "time" and each column name to a list of values. Times are encoded as ISO formatted
+    strings, or as milliseconds since the epoch if epoch is set.
+    """
+    encoded: dict[str, Sequence] = {"time": times}
+    if epoch:
+        encoded["time"] = [round(time.timestamp() * 1000) for time in times]
+    for name, values in columns.items():
+        # orjson can't encode arrays, but converting them to lists is cheap
+        encoded[name] = values.tolist() if isinstance(values, array) else values
+    return orjson.dumps(encoded, option=orjson.OPT_APPEND_NEWLINE)
@@ -0,0 +1,218 @@
+"""
+Write-behind buffer for uploaded readings. Rather than inserting and committing each
+upload in the request that receives it, uploads are queued in each worker process and
+written by a background thread with multi-row inserts, so that many uploads share a
+single commit.
+
+When an upload is acknowledged depends on the durability mode:
+ - group: the request waits until the batch containing its readings is committed
+ - async: the request returns as soon as its readings are queued. Queued readings are
+   lost if the worker is killed before they are written.
+Queued readings are written when the worker shuts down cleanly.
+
+The buffer is created with the app and stored in app.extensions, but its thread is only
+started by the first upload, so that it runs in the worker process that serves requests.
+"""
+
+import atexit
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Condition, Event, Thread
+from typing import TYPE_CHECKING, Any, Optional
+
+from flask import Flask
+
+if TYPE_CHECKING:
+    from .db.fridge_table import SensorReading
+
+logger = logging.getLogger(__name__)
+
+# How uploads are acknowledged. sync writes each upload in its own request, without the buffer.
+DURABILITY_MODES = ("sync", "group", "async")
+
+# Key of the write buffer in app.extensions
+EXTENSION_NAME = "labmon_write_buffer"
+
+
+class QueueFull(Exception):
+    """
+    Raised when there is no space left in the buffer for an upload
+    """
+
+
+class WriteTimeout(Exception):
+    """
+    Raised when an upload isn't committed in time. The readings may still be written.
+    """
+
+
+@dataclass(eq=False)
+class PendingWrite:
+    fridge_table: type["SensorReading"]
+    rows: list[dict[str, Any]]
+    on_conflict: str
+    done: Event = field(default_factory=Event)
+    error: Optional[Exception] = None
+
+
+class WriteBuffer:
+    def __init__(
+        self,
+        app: Flask,
+        max_rows: int,
+        flush_interval: float,
+        flush_rows: int,
+        wait_timeout: Optional[float] = None,
+    ):
+        """
+        Create a buffer holding up to max_rows readings, which are written every
+        flush_interval seconds, or as soon as flush_rows readings are queued. Uploads
+        that wait to be committed give up after wait_timeout seconds.
+        """
+        self.app = app
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.wait_timeout = wait_timeout
+        self.size = 0
+        self._pending: deque[PendingWrite] = deque()
+        self._cond = Condition()
+        self._stopped = False
+        self._thread: Optional[Thread] = None
+
+    def submit(
+        self,
+        fridge_table: type["SensorReading"],
+        rows: list[dict[str, Any]],
+        on_conflict: str = "ignore",
+        wait: bool = False,
+    ):
+        """
+        Queue readings to be written to a fridge table. If wait is set, block until they
+        have been committed, raising any error from writing them, or WriteTimeout if they
+        aren't committed in time. Raises QueueFull if there isn't space in the buffer.
+        """
+        pending = PendingWrite(fridge_table, rows, on_conflict)
+        with self._cond:
+            if self._stopped:
+                raise QueueFull("The write buffer has been shut down")
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="labmon-write-buffer", daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+            if self.size + len(rows) > self.max_rows:
+                raise QueueFull(f"Write buffer full ({self.size} readings queued)")
+            self._pending.append(pending)
+            self.size += len(rows)
+            if self.size >= self.flush_rows:
+                self._cond.notify()
+
+        if wait:
+            if not pending.done.wait(self.wait_timeout):
+                raise WriteTimeout(f"Timed out waiting for {len(rows)} readings to be written")
+            if pending.error is not None:
+                raise pending.error
+
+    def stop(self):
+        """
+        Write any queued readings and stop the background thread
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.size >= self.flush_rows or self._stopped,
+                    timeout=self.flush_interval,
+                )
+                batch = list(self._pending)
+                self._pending.clear()
+                self.size = 0
+                stopped = self._stopped
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # Keep the thread running, and release any uploads still waiting
+                    logger.exception("Failed to write a batch of %d uploads", len(batch))
+                    for pending in batch:
+                        if not pending.done.is_set():
+                            pending.error = e
+                            pending.done.set()
+            if stopped:
+                return
+
+    def _write(self, batch: list[PendingWrite]):
+        """
+        Write a batch of uploads, with a single insert and commit for each table. If the
+        combined insert fails, each upload is retried on its own, so that one bad upload
+        doesn't fail the others.
+        """
+        groups: dict[tuple[type["SensorReading"], str], list[PendingWrite]] = {}
+        for pending in batch:
+            groups.setdefault((pending.fridge_table, pending.on_conflict), []).append(pending)
+
+        with self.app.app_context():
+            for (fridge_table, on_conflict), group in groups.items():
+                rows = [row for pending in group for row in pending.rows]
+                if len(group) > 1:
+                    try:
+                        fridge_table.append_many(rows, on_conflict=on_conflict)
+                    except Exception:  # pylint: disable=broad-exception-caught
+                        logger.warning(
+                            "Failed to write %d readings to %s, retrying each upload",
+                            len(rows),
+                            fridge_table.__table__.name,
+                            exc_info=True,
+                        )
+                    else:
+                        for pending in group:
+                            pending.done.set()
+                        continue
+                for pending in group:
+                    self._write_upload(pending)
+
+    def _write_upload(self, pending: PendingWrite):
+        """
+        Write a single upload, storing any error for the request waiting on it
+        """
+        try:
+            pending.fridge_table.append_many(pending.rows, on_conflict=pending.on_conflict)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.exception(
+                "Failed to write %d readings to %s",
+                len(pending.rows),
+                pending.fridge_table.__table__.name,
+            )
+            pending.error = e
+        pending.done.set()
+
+
+def init_write_buffer(app: Flask):
+    """
+    Create the write buffer for an app, unless uploads are written synchronously. The
+    buffer is flushed when the process exits.
+    """
+    if app.config.get("WRITE_DURABILITY", "sync") == "sync":
+        return
+    app.extensions[EXTENSION_NAME] = WriteBuffer(
+        app,
+        max_rows=app.config.get("WRITE_QUEUE_SIZE", 100_000),
+        flush_interval=app.config.get("WRITE_FLUSH_INTERVAL", 0.1),
+        flush_rows=app.config.get("WRITE_FLUSH_ROWS", 5000),
+        wait_timeout=app.config.get("WRITE_WAIT_TIMEOUT", 30.0),
+    )
+
+
+def get_write_buffer(app: Flask) -> WriteBuffer:
+    """
+    Return the write buffer of an app
+    """
+    return app.extensions[EXTENSION_NAME]
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS labmon_table_versions (
+        table_name VARCHAR(255) NOT NULL,
+        version BIGINT NOT NULL,
+        changed TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (table_name)
+);
+CREATE TABLE IF NOT EXISTS labmon_changes (
+        table_name VARCHAR(255) NOT NULL,
+        version BIGINT NOT NULL,
+        first_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        last_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        changed TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (table_name, version)
+);
+CREATE INDEX IF NOT EXISTS ix_labmon_changes_changed ON labmon_changes (changed);
@@ -0,0 +1,4 @@
+ALTER TABLE fridges ADD COLUMN IF NOT EXISTS compress_after VARCHAR(255);
+ALTER TABLE fridges ADD COLUMN IF NOT EXISTS retain_raw VARCHAR(255);
+ALTER TABLE fridges_supplementary ADD COLUMN IF NOT EXISTS compress_after VARCHAR(255);
+ALTER TABLE fridges_supplementary ADD COLUMN IF NOT EXISTS retain_raw VARCHAR(255);
@@ -0,0 +1,67 @@
+"""
+Benchmark serialization of fridge data to JSON, comparing the previous approach (checking
+each value in python then encoding with jsonify) against labmon.utility.fastjson.
+Doesn't require a database. Run with:
+    python tests/bench_fridge_data.py [rows] [sensors]
+"""
+
+import random
+import sys
+from datetime import datetime, timedelta
+from math import isinf, isnan
+from timeit import repeat
+
+from flask import Flask
+from flask.json import jsonify
+
+from labmon.utility.fastjson import dumps_columns
+
+N_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+N_SENSORS = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+REPEATS = 5
+
+
+def make_data(n_rows, n_sensors):
+    start = datetime.now().astimezone() - timedelta(seconds=10 * n_rows)
+    times = [start + timedelta(seconds=10 * i) for i in range(n_rows)]
+    invalid = [None, float("nan"), float("inf"), float("-inf")]
+    data = {}
+    for i in range(n_sensors):
+        data[f"sensor_{i}"] = [
+            random.choice(invalid) if random.random() < 0.01 else random.uniform(0.01, 300)
+            for _ in range(n_rows)
+        ]
+    return times, data
+
+
+def format_data(times, data):
+    # Previous implementation of FridgeView._format_data
+    formatted = {"time": [time.isoformat() for time in times]}
+    for field_name, values in data.items():
+        formatted[field_name] = [
+            None if val is not None and (isnan(val) or isinf(val)) else val for val in values
+        ]
+    return formatted
+
+
+def main():
+    app = Flask(__name__)
+    times, data = make_data(N_ROWS, N_SENSORS)
+
+    with app.app_context():
+        benchmarks = {
+            "jsonify (previous)": lambda: jsonify(format_data(times, data)).get_data(),
+            "fastjson, ISO times": lambda: dumps_columns(times, data),
+            "fastjson, epoch times": lambda: dumps_columns(times, data, epoch=True),
+        }
+        print(f"Serializing {N_ROWS} rows of {N_SENSORS} sensors, best of {REPEATS}")
+        results = {}
+        for name, func in benchmarks.items():
+            results[name] = min(repeat(func, number=1, repeat=REPEATS))
+        baseline = results["jsonify (previous)"]
+        for name, elapsed in results.items():
+            print(f"{name:<24} {elapsed * 1000:8.1f} ms  {baseline / elapsed:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
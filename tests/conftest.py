@@ -0,0 +1,15 @@
+"""
+Configuration for the pytest test suite. Importing labmon requires a config file, so
+the tests use a default config in a temporary directory rather than the user's config.
+The other scripts in this directory are run by hand against a configured server.
+"""
+
+import os
+import tempfile
+from pathlib import Path
+
+_config_dir = tempfile.mkdtemp(prefix="labmon_test_")
+Path(_config_dir, "labmon_config.json").write_text("{}", encoding="utf-8")
+os.environ["THERM_CONFIG"] = _config_dir
+
+collect_ignore = ["test.py", "test_db.py", "test_hilbert.py", "bluefors_upload.py"]
@@ -0,0 +1,43 @@
+import gzip
+
+from flask import Response
+
+from labmon.cache import ResponseCache
+
+
+def test_hit_is_gzip_encoded():
+    cache = ResponseCache(1024)
+    cache.put("key", Response(b"data", mimetype="application/json"), version=3)
+    r = cache.get("key", accept_gzip=True)
+    assert r.content_encoding == "gzip"
+    assert gzip.decompress(r.get_data()) == b"data"
+    assert cache.get("key", accept_gzip=False).get_data() == b"data"
+
+
+def test_invalid_entry_is_removed():
+    cache = ResponseCache(1024)
+    cache.put("key", Response(b"data"), version=3)
+    versions = []
+
+    def is_valid(cached):
+        versions.append(cached.version)
+        return False
+
+    assert cache.get("key", is_valid=is_valid) is None
+    assert versions == [3]
+    assert cache.size == 0
+    assert cache.get("key") is None
+
+
+def test_valid_entry_is_kept():
+    cache = ResponseCache(1024)
+    cache.put("key", Response(b"data"), version=3)
+    assert cache.get("key", is_valid=lambda cached: True) is not None
+    assert cache.get("key") is not None
+
+
+def test_response_larger_than_cache_is_not_stored():
+    cache = ResponseCache(16)
+    cache.put("key", Response(b"0" * 17), version=3)
+    assert cache.get("key") is None
+    assert cache.size == 0
@@ -0,0 +1,80 @@
+import struct
+from array import array
+from datetime import datetime, timedelta, timezone
+from math import inf, isnan, nan
+
+from labmon.utility.columnar import MAGIC, pack_columns
+from labmon.utility.fastjson import dumps_columns
+
+
+def _unpack(buf: bytes) -> tuple[list[int], dict[str, list]]:
+    """
+    Decode the columnar format as described in labmon.utility.columnar, returning
+    missing readings as None
+    """
+
+    def aligned(offset: int) -> int:
+        return offset + -offset % 8
+
+    assert buf[:4] == MAGIC
+    n_rows, n_cols = struct.unpack_from("<II", buf, 4)
+    offset = 12
+    names = []
+    for _ in range(n_cols):
+        (length,) = struct.unpack_from("<H", buf, offset)
+        names.append(buf[offset + 2 : offset + 2 + length].decode("utf-8"))
+        offset += 2 + length
+    offset = aligned(offset)
+
+    times = list(struct.unpack_from(f"<{n_rows}q", buf, offset))
+    offset += 8 * n_rows
+    columns = {}
+    for name in names:
+        validity = buf[offset : offset + (n_rows + 7) // 8]
+        offset = aligned(offset + len(validity))
+        values = struct.unpack_from(f"<{n_rows}d", buf, offset)
+        offset += 8 * n_rows
+        columns[name] = [
+            val if validity[i >> 3] & (1 << (i & 7)) else None for i, val in enumerate(values)
+        ]
+    assert offset == len(buf)
+    return times, columns
+
+
+def test_round_trip():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    times = [start + timedelta(seconds=10 * i) for i in range(11)]
+    columns = {
+        "MC": array("d", [0.01 * i for i in range(11)]),
+        "Still": [1.0, None, nan, inf, -inf, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0],
+        "Ünïcode": [float(i) for i in range(11)],
+    }
+    packed = pack_columns(times, columns)
+    assert len(packed) % 8 == 0
+
+    unpacked_times, unpacked = _unpack(packed)
+    assert unpacked_times == [round(time.timestamp() * 1000) for time in times]
+    assert list(unpacked) == list(columns)
+    assert unpacked["MC"] == list(columns["MC"])
+    assert unpacked["Still"] == [1.0, None, None, None, None, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+
+
+def test_empty():
+    times, columns = _unpack(pack_columns([], {"MC": []}))
+    assert times == [] and columns == {"MC": []}
+
+
+def test_epoch_matches_json():
+    # Times just short of a whole millisecond must not be truncated by either format
+    times = [datetime(2024, 1, 1, 0, 0, 0, 999_700, tzinfo=timezone.utc)]
+    packed_times, _ = _unpack(pack_columns(times, {"MC": [1.0]}))
+    assert dumps_columns(times, {"MC": [1.0]}, epoch=True) == (
+        f'{{"time":[{packed_times[0]}],"MC":[1.0]}}\n'.encode()
+    )
+    assert packed_times[0] == 1704067201000
+
+
+def test_nan_values_stored_as_nan():
+    packed = pack_columns([datetime(2024, 1, 1, tzinfo=timezone.utc)], {"MC": [None]})
+    (value,) = struct.unpack_from("<d", packed, len(packed) - 8)
+    assert isnan(value)
@@ -0,0 +1,77 @@
+from math import inf, nan
+
+import pytest
+
+from labmon.utility.downsample import downsample, lttb, minmax
+
+
+def test_lttb_keeps_endpoints_and_threshold():
+    x = list(range(100))
+    y = [float(i % 7) for i in x]
+    sampled = lttb(x, [y], 10)
+    assert len(sampled) == 10
+    assert sampled[0] == 0 and sampled[-1] == 99
+    assert sampled == sorted(sampled)
+
+
+def test_lttb_keeps_spike():
+    x = list(range(50))
+    y = [0.0] * 50
+    y[23] = 100.0
+    assert 23 in lttb(x, [y], 5)
+
+
+def test_lttb_returns_everything_below_threshold():
+    assert lttb([0, 1, 2], [[1.0, 2.0, 3.0]], 10) == [0, 1, 2]
+
+
+def test_minmax_keeps_extremes_of_each_bucket():
+    y = [3.0, 1.0, 5.0, 2.0, 9.0, 0.0, 4.0, 6.0]
+    # Two buckets of four points each
+    assert minmax([y], 4) == [1, 2, 4, 5]
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_downsample_keeps_endpoints(method):
+    x = [float(i) for i in range(200)]
+    y = [float(i * i % 13) for i in range(200)]
+    keep = downsample(x, [y], 20, method)
+    assert keep[0] == 0 and keep[-1] == 199
+    assert keep == sorted(set(keep))
+    assert len(keep) < 200
+
+
+def test_downsample_ignores_invalid_values():
+    x = [float(i) for i in range(100)]
+    y = [nan if i % 2 else float(i) for i in range(100)]
+    y[50] = inf
+    y[52] = None
+    keep = downsample(x, [y], 10, "minmax")
+    # Only the end points may be invalid
+    assert all(i in (0, 99) or i % 2 == 0 for i in keep)
+    assert 50 not in keep and 52 not in keep
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_downsample_combines_series(method):
+    x = [float(i) for i in range(60)]
+    first = [0.0] * 60
+    first[10] = 1.0
+    second = [0.0] * 60
+    second[40] = -1000.0
+    keep = downsample(x, [first, second], 6, method)
+    # Each series is scaled to its range, so a spike in either is kept
+    assert 10 in keep and 40 in keep
+    assert len(keep) <= 6
+
+
+def test_downsample_bounds_points_for_many_series():
+    x = [float(i) for i in range(1000)]
+    series = [[float((i * (k + 3)) % 17) for i in range(1000)] for k in range(10)]
+    for method in ("lttb", "minmax"):
+        assert len(downsample(x, series, 50, method)) <= 50
+
+
+def test_downsample_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        downsample([0.0, 1.0], [[0.0, 1.0]], 3, "mean")
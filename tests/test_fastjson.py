@@ -0,0 +1,33 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+from math import inf, nan
+
+from labmon.utility.fastjson import dumps_columns
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TIMES = [START, START + timedelta(seconds=10)]
+
+
+def test_iso_times():
+    decoded = json.loads(dumps_columns(TIMES, {"MC": [1.0, 2.0]}))
+    assert decoded == {"time": [time.isoformat() for time in TIMES], "MC": [1.0, 2.0]}
+
+
+def test_epoch_times():
+    decoded = json.loads(dumps_columns(TIMES, {"MC": [1.0, 2.0]}, epoch=True))
+    assert decoded["time"] == [1704067200000, 1704067210000]
+
+
+def test_invalid_values_are_null():
+    decoded = json.loads(dumps_columns(TIMES * 2, {"MC": [nan, inf, -inf, None]}))
+    assert decoded["MC"] == [None, None, None, None]
+
+
+def test_arrays():
+    decoded = json.loads(dumps_columns(TIMES, {"MC": array("d", [0.5, nan])}))
+    assert decoded["MC"] == [0.5, None]
+
+
+def test_newline_terminated():
+    assert dumps_columns([], {}).endswith(b"\n")
@@ -0,0 +1,230 @@
+import io
+from array import array
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from flask import Flask
+
+import labmon.cache
+from labmon import export, fridge_data
+from labmon.fridge_data import fridge_bp
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TIMES = [T0 + timedelta(seconds=10 * i) for i in range(10)]
+READINGS = {"MC": [float(i) for i in range(10)], "Still": [10.0 * i for i in range(10)]}
+
+
+class StubReadings:
+    """
+    Stands in for a SensorReading table, reading from TIMES and READINGS and recording
+    the queries made of it
+    """
+
+    calls: list[tuple] = []
+
+    @classmethod
+    def sensor_names(cls) -> list[str]:
+        return list(READINGS)
+
+    @classmethod
+    def latest_time(cls) -> datetime:
+        return TIMES[-1]
+
+    @classmethod
+    def _columns(cls, keep, columns=None):
+        names = cls.sensor_names() if columns is None else columns
+        times = [TIMES[i] for i in keep]
+        return times, {name: array("d", (READINGS[name][i] for i in keep)) for name in names}
+
+    @classmethod
+    def get_last_columns(cls, n=1, columns=None):
+        return cls._columns(range(len(TIMES))[-n:], columns)
+
+    @classmethod
+    def get_since_columns(cls, since, n, columns=None):
+        return cls._columns([i for i, time in enumerate(TIMES) if time > since][:n], columns)
+
+    @classmethod
+    def get_page_columns(cls, start, stop, limit, after=None, columns=None):
+        keep = [
+            i
+            for i, time in enumerate(TIMES)
+            if start <= time <= stop and (after is None or time > after)
+        ]
+        return cls._columns(keep[:limit], columns)
+
+    @classmethod
+    def get_between_columns(cls, start=None, stop=None, columns=None):
+        return cls._columns([i for i, time in enumerate(TIMES) if start <= time <= stop], columns)
+
+    @classmethod
+    def avg_data_columns(cls, time_period="hour", start=None, stop=None, count=None, columns=None):
+        cls.calls.append(("avg_data_columns", time_period, start, stop, count, columns))
+        names = cls.sensor_names() if columns is None else columns
+        bucket = T0.replace(minute=0, second=0)
+        return [bucket], {name: array("d", [sum(READINGS[name]) / 10]) for name in names}
+
+    @classmethod
+    def export_csv(cls, start=None, stop=None, columns=None):
+        cls.calls.append(("export_csv", start, stop, columns))
+        names = cls.sensor_names() if columns is None else columns
+        yield ("time," + ",".join(names) + "\n").encode()
+        times, data = cls._columns(range(len(TIMES)), columns)
+        for i, time in enumerate(times):
+            yield (",".join([time.isoformat(), *(str(data[n][i]) for n in names)]) + "\n").encode()
+
+    @classmethod
+    def export_columns(cls, start=None, stop=None, columns=None, batch_size=10_000):
+        for first in range(0, len(TIMES), batch_size):
+            yield cls._columns(range(first, min(first + batch_size, len(TIMES))), columns)
+
+
+DATA_SOURCE = SimpleNamespace(
+    name="BF",
+    table_name="bf",
+    sensors=[SimpleNamespace(column_name=name) for name in READINGS],
+    fridge_table=lambda: StubReadings,
+)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    def get_fridge_metadata(fridge_name, supp):
+        if fridge_name != "BF" or supp is not None:
+            raise KeyError(fridge_name)
+        return DATA_SOURCE
+
+    monkeypatch.setattr(fridge_data, "get_fridge_metadata", get_fridge_metadata)
+    monkeypatch.setattr(export, "get_fridge_metadata", get_fridge_metadata)
+    # Without a change log the views fall back to the time of the latest reading
+    monkeypatch.setattr(fridge_data, "get_version", lambda table_name: None)
+    monkeypatch.setattr(labmon.cache, "_cache", None)
+    monkeypatch.setattr(StubReadings, "calls", [])
+
+    app = Flask(__name__)
+    app.register_blueprint(fridge_bp)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_since_returns_cursor_for_next_request(client):
+    r = client.get("/BF", query_string={"since": TIMES[2].isoformat(), "count": 3})
+    assert r.status_code == 200
+    assert r.json["time"] == [time.isoformat() for time in TIMES[3:6]]
+    assert r.headers["X-Cursor"] == TIMES[5].isoformat()
+
+    r = client.get("/BF", query_string={"since": r.headers["X-Cursor"]})
+    assert r.json["time"] == [time.isoformat() for time in TIMES[6:]]
+    assert r.headers["X-Cursor"] == TIMES[-1].isoformat()
+
+
+def test_since_rejects_invalid_cursor(client):
+    assert client.get("/BF?since=yesterday").status_code == 400
+
+
+def test_pages_link_to_the_next_page(client):
+    query = {"start": TIMES[0].isoformat(), "stop": TIMES[-1].isoformat(), "limit": 4}
+    times = []
+    r = client.get("/BF", query_string=query)
+    while "Link" in r.headers:
+        times.extend(r.json["time"])
+        assert r.headers["X-Cursor"] == r.json["time"][-1]
+        next_url = urlsplit(r.headers["Link"].split(";")[0].strip("<>"))
+        assert parse_qs(next_url.query)["after"] == [r.headers["X-Cursor"]]
+        r = client.get(f"{next_url.path}?{next_url.query}")
+    times.extend(r.json["time"])
+    assert "X-Cursor" not in r.headers
+    assert times == [time.isoformat() for time in TIMES]
+
+
+@pytest.mark.parametrize("query", [{"limit": 0}, {"limit": 10, "avg_period": "hour"}])
+def test_pages_reject_invalid_arguments(client, query):
+    query.update({"start": TIMES[0].isoformat(), "stop": TIMES[-1].isoformat()})
+    assert client.get("/BF", query_string=query).status_code == 400
+
+
+def test_columns_select_sensors(client):
+    r = client.get("/BF?count=2&columns=Still")
+    assert r.status_code == 200
+    assert set(r.json) == {"time", "Still"}
+    assert r.json["Still"] == READINGS["Still"][-2:]
+
+
+def test_unknown_columns_are_rejected(client):
+    r = client.get("/BF?count=2&columns=Still,Four_K")
+    assert r.status_code == 400
+    assert b"Four_K" in r.data
+
+
+def test_requests_in_the_same_bucket_share_cached_response(app, client, monkeypatch):
+    monkeypatch.setattr(fridge_data, "changed_between", lambda *args: False)
+    app.config["RESPONSE_CACHE_SIZE"] = 1_000_000
+    responses = []
+    for offset in (0, 5):
+        start = T0 + timedelta(minutes=offset)
+        query = {
+            "start": start.isoformat(),
+            "stop": (start + timedelta(hours=2)).isoformat(),
+            "avg_period": "15min",
+        }
+        responses.append(client.get("/BF", query_string=query))
+    assert all(r.status_code == 200 for r in responses)
+    assert responses[0].json == responses[1].json
+    # Both ranges cover the same 15 minute buckets, so the second is served from the cache
+    assert len(StubReadings.calls) == 1
+
+
+def test_auto_period_and_columns_are_passed_to_the_table(client):
+    query = {
+        "start": T0.isoformat(),
+        "stop": (T0 + timedelta(days=20)).isoformat(),
+        "avg_period": "auto",
+        "columns": "MC",
+    }
+    r = client.get("/BF", query_string=query)
+    assert r.status_code == 200
+    ((_, period, start, stop, count, columns),) = StubReadings.calls
+    assert (period, start, count, columns) == ("hour", T0, None, ["MC"])
+    assert stop == T0 + timedelta(days=20)
+
+
+@pytest.mark.parametrize("query", [{}, {"stats": ""}])
+def test_raw_interval_is_limited(client, query):
+    query.update({"start": T0.isoformat(), "stop": (T0 + timedelta(days=31)).isoformat()})
+    assert client.get("/BF", query_string=query).status_code == 400
+
+
+def test_export_csv(client):
+    r = client.get("/BF/export", query_string={"start": T0.isoformat(), "columns": "MC"})
+    assert r.status_code == 200
+    assert r.mimetype == "text/csv"
+    assert r.headers["Content-Disposition"] == 'attachment; filename="bf.csv"'
+    lines = r.get_data(as_text=True).splitlines()
+    assert lines[0] == "time,MC"
+    assert len(lines) == len(TIMES) + 1
+    assert StubReadings.calls == [("export_csv", T0, None, ["MC"])]
+
+
+def test_export_parquet(client, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 4)
+    r = client.get("/BF/export?format=parquet")
+    assert r.status_code == 200
+    assert r.headers["Content-Disposition"] == 'attachment; filename="bf.parquet"'
+    parquet = pq.ParquetFile(io.BytesIO(r.get_data()))
+    # A row group is written for each batch read from the table
+    assert parquet.num_row_groups == 3
+    table = parquet.read()
+    assert table.column_names == ["time", "MC", "Still"]
+    assert table.column("time").to_pylist() == TIMES
+    assert table.column("Still").to_pylist() == READINGS["Still"]
+
+
+def test_export_rejects_unknown_format(client):
+    assert client.get("/BF/export?format=xlsx").status_code == 400
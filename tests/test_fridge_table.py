@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from flask import Flask
+from sqlalchemy import TIMESTAMP, Column, Float
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import mapped_column
+
+from labmon.db.db import Base, db
+from labmon.db.fridge_table import MAX_CHANNEL_LENGTH, SensorReading, choose_period, live_channel
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+T1 = T0 + timedelta(seconds=10)
+
+# A fridge table built the same way as FridgeModel.fridge_table
+Readings = type(
+    "test_readings",
+    (Base, SensorReading),
+    {
+        "__tablename__": "test_readings",
+        "__annotations__": {"time": Column, "MC": Column, "Still": Column},
+        "time": mapped_column(TIMESTAMP(timezone=True), primary_key=True),
+        "MC": mapped_column(Float, nullable=True),
+        "Still": mapped_column(Float, nullable=True),
+    },
+)
+
+
+@pytest.fixture
+def app():
+    """
+    An app with the readings table in an in-memory SQLite database, which supports the
+    same ON CONFLICT clauses as Postgres
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        Readings.__table__.create(db.engine)
+        yield app
+
+
+def _upsert_sql(on_conflict: str) -> str:
+    query = Readings._upsert([{"time": T0, "MC": 1.0, "Still": None}], on_conflict)
+    return " ".join(str(query.compile(dialect=postgresql.dialect())).split())
+
+
+def _store(*rows):
+    # Insert readings without recording them in the change log, which needs Postgres
+    db.session.execute(Readings._upsert(list(rows), "ignore"))
+    db.session.commit()
+
+
+@pytest.mark.parametrize(
+    "span, points, period",
+    [
+        (timedelta(minutes=10), 1000, "10s"),
+        (timedelta(hours=12), 1000, "1min"),
+        (timedelta(days=3), 1000, "5min"),
+        (timedelta(days=10), 1000, "15min"),
+        (timedelta(days=30), 1000, "hour"),
+        (timedelta(days=365), 1000, "day"),
+        (timedelta(days=365 * 100), 1000, "month"),
+        (timedelta(days=365 * 1000), 10, "month"),
+    ],
+)
+def test_choose_period(span, points, period):
+    assert choose_period(span, points) == period
+
+
+def test_merge_overwrites_given_sensors():
+    rows = [
+        {"time": T0, "MC": 1.0, "Still": 2.0},
+        {"time": T0, "MC": 3.0},
+        {"time": T1, "Still": 4.0},
+        {"time": T0, "Still": None},
+    ]
+    assert SensorReading._combine_readings(rows, "merge") == [
+        {"time": T0, "MC": 3.0, "Still": None},
+        {"time": T1, "Still": 4.0},
+    ]
+
+
+def test_fill_keeps_first_valid_value():
+    rows = [
+        {"time": T0, "MC": 1.0, "Still": None},
+        {"time": T0, "MC": 3.0, "Still": 4.0},
+        {"time": T0, "Still": 5.0},
+    ]
+    assert SensorReading._combine_readings(rows, "fill") == [
+        {"time": T0, "MC": 1.0, "Still": 4.0},
+    ]
+
+
+def test_live_channel_fits_long_table_names():
+    assert live_channel("bluefors") == "labmon_bluefors"
+    channel = live_channel("a_very_long_supplementary_table_name" * 3)
+    assert len(channel.encode()) <= MAX_CHANNEL_LENGTH
+    assert channel != live_channel("another_very_long_supplementary_table_name" * 3)
+
+
+def test_ignore_does_nothing_on_conflict():
+    assert "ON CONFLICT (time) DO NOTHING" in _upsert_sql("ignore")
+
+
+def test_fill_only_updates_null_sensors():
+    sql = _upsert_sql("fill")
+    assert 'DO UPDATE SET "MC" = coalesce(test_readings."MC", excluded."MC")' in sql
+    assert (
+        'WHERE test_readings."MC" IS NULL AND excluded."MC" IS NOT NULL '
+        'OR test_readings."Still" IS NULL AND excluded."Still" IS NOT NULL'
+    ) in sql
+
+
+def test_merge_only_updates_changed_sensors():
+    sql = _upsert_sql("merge")
+    assert 'DO UPDATE SET "MC" = excluded."MC", "Still" = excluded."Still"' in sql
+    assert (
+        'WHERE test_readings."MC" IS DISTINCT FROM excluded."MC" '
+        'OR test_readings."Still" IS DISTINCT FROM excluded."Still"'
+    ) in sql
+
+
+def test_unknown_conflict_mode_is_rejected():
+    with pytest.raises(ValueError):
+        Readings._upsert([{"time": T0, "MC": 1.0}], "replace")
+
+
+@pytest.mark.parametrize("on_conflict", ["ignore", "fill", "merge"])
+def test_replayed_upload_is_a_no_op(app, on_conflict):  # pylint: disable=unused-argument
+    _store({"time": T0, "MC": 1.0, "Still": 2.0}, {"time": T1, "MC": 3.0, "Still": None})
+    rows = [{"time": T0, "MC": 1.0, "Still": 2.0}, {"time": T1, "MC": 3.0}]
+    assert Readings.append_many(rows, on_conflict=on_conflict) == 0
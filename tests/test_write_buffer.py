@@ -0,0 +1,41 @@
+import pytest
+from flask import Flask
+
+from labmon.write_buffer import WriteBuffer, WriteTimeout
+
+
+class FakeTable:
+    class __table__:  # pylint: disable=invalid-name
+        name = "fake"
+
+    written: list = []
+
+    @classmethod
+    def append_many(cls, rows, on_conflict="ignore"):
+        if any(row.get("bad") for row in rows):
+            raise KeyError("Invalid column name")
+        cls.written.extend(rows)
+        return len(rows)
+
+
+@pytest.fixture
+def buffer():
+    FakeTable.written = []
+    buffer = WriteBuffer(Flask(__name__), max_rows=100, flush_interval=60, flush_rows=100)
+    yield buffer
+    buffer.stop()
+
+
+def test_bad_upload_does_not_fail_batch(buffer):
+    # The uploads are written together when the buffer is stopped
+    buffer.submit(FakeTable, [{"time": 1}])
+    buffer.submit(FakeTable, [{"time": 2, "bad": True}])
+    buffer.submit(FakeTable, [{"time": 3}])
+    buffer.stop()
+    assert sorted(row["time"] for row in FakeTable.written) == [1, 3]
+
+
+def test_wait_times_out(buffer):
+    buffer.wait_timeout = 0.01
+    with pytest.raises(WriteTimeout):
+        buffer.submit(FakeTable, [{"time": 1}], wait=True)